@@ -6,19 +6,19 @@ import traceback
 
 from pyrum import Rumor
 
-from remerkleable.complex import Container
-from remerkleable.byte_arrays import Bytes32, Bytes4
-from remerkleable.basic import uint64
-
 from eth2spec.config.config_util import prepare_config
 
 from importlib import reload
 
 import csv
 
-from remerkleable.tree import Node
 import fast_spec
 
+from sync import Goodbye, Status, RumorPeer, sync_blocks, block_file_name
+from lookahead import SlotLookahead, head_block_root
+from state_tx import state_transaction
+from workers import LoopLagMonitor, StateWorkers
+
 # Apply lighthouse config to spec
 prepare_config("./lighthouse", "config")
 reload(fast_spec)
@@ -30,24 +30,8 @@ spec = fast_spec
 # Turn off sig verification
 spec.bls.bls_active = False
 
-
-class Goodbye(uint64):
-    pass
-
-
-class Status(Container):
-    version: Bytes4
-    finalized_root: Bytes32
-    finalized_epoch: uint64
-    head_root: Bytes32
-    head_slot: uint64
-
-
-class BlocksByRange(Container):
-    head_block_root: Bytes32
-    start_slot: uint64
-    count: uint64
-    step: uint64
+# Record the sync start state and all synced blocks in this directory (e.g. 'fixtures'), to replay with bench_replay.py
+fixtures_dir = None
 
 
 bootnodes = [
@@ -87,11 +71,18 @@ async def lit_morty(rumor: Rumor):
     print(morty_status.encode_bytes().hex())
 
 
-    async def sync_from_bootnode(state: spec.BeaconState):
+    async def sync_from_bootnodes(state: spec.BeaconState):
         await trio.sleep(2)
 
-        peer_id = await morty.peer.connect(bootnodes[0], "bootnode").peer_id()
-        print(f"connected bootnode peer: {peer_id}")
+        peer_ids = []
+        for i, enr in enumerate(bootnodes):
+            try:
+                peer_id = await morty.peer.connect(enr, f"bootnode{i}").peer_id()
+            except Exception as e:
+                print(f"failed to connect to bootnode {i}: {e}")
+                continue
+            print(f"connected bootnode peer: {peer_id}")
+            peer_ids.append(peer_id)
 
         # boot_status = await ask_status(peer_id)
         # print("Bootnode status:", boot_status)
@@ -101,73 +92,41 @@ async def lit_morty(rumor: Rumor):
         # Play nice, don't hit them with another request right away, wait half a minute. (Age?!)
         # await trio.sleep(31)
 
-        async def sync_step(stats_csv: csv.DictWriter, epochs_ctx: fast_spec.EpochsContext, state: fast_spec.BeaconState) -> spec.BeaconState:
-            range_req = BlocksByRange(start_slot=state.slot + 1, count=20, step=1).encode_bytes().hex()
-            print("range req:", range_req)
-            blocks = []
-            async for chunk in morty.rpc.blocks_by_range.req.raw(peer_id, range_req, max_chunks=10, raw=True).chunk():
-                print("got chunk: ", chunk)
-                if chunk['result_code'] == 0:
-                    block = spec.SignedBeaconBlock.decode_bytes(bytes.fromhex(chunk["data"]))
-                    blocks.append(block)
-                else:
-                    print("failed to get block; msg: ", chunk["msg"])
-                    break
-
-            for b in blocks:
-                print("processing block!")
-                start_time = time.time()
-                if state.slot > 500 and (state.slot + 1) % fast_spec.SLOTS_PER_EPOCH == 0:
-                    with io.open('pre.ssz', 'bw') as f:
-                        state.serialize(f)
-                    with io.open('block.ssz', 'bw') as f:
-                        b.serialize(f)
-                    import sys
-                    sys.exit(1)
-
-                transition_input_state = state.copy()
-                fast_spec.state_transition(epochs_ctx, transition_input_state, b)
-
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                print(f"slot: {state.slot} state root: {state.hash_tree_root().hex()}  processing speed: {1.0 / elapsed_time} blocks / second  ({elapsed_time * 1000.0} ms/block)")
-
-                def subtree_size(n: Node) -> int:
-                    if n.is_leaf():
-                        return 1
-                    return subtree_size(n.get_left()) + subtree_size(n.get_right())
-
-                def analyze_diff(a: Node, b: Node) -> (int, int):
-                    """Iterate over the changes of b, not common with a. Left-to-right order.
-                     Returns (a,b) tuples that can't be diffed deeper."""
-                    if a.root != b.root:
-                        a_leaf = a.is_leaf()
-                        b_leaf = b.is_leaf()
-                        if a_leaf or b_leaf:
-                            return subtree_size(a), subtree_size(b)
-                        else:
-                            a_l, b_l = analyze_diff(a.get_left(), b.get_left())
-                            a_r, b_r = analyze_diff(a.get_right(), b.get_right())
-                            return a_l + a_r + 1, b_l + b_r + 1
-                    return 0, 0
-
-                stats = {
-                    'slot': b.message.slot,
-                    'proposer': epochs_ctx.get_beacon_proposer(b.message.slot),
-                    'process_time': elapsed_time,
-                }
-                # for i, key in enumerate(spec.BeaconState.fields().keys()):
-                #     a = state.get(i).get_backing()
-                #     b = transition_input_state.get(i).get_backing()
-                #
-                #     removed_nodes, added_nodes = analyze_diff(a, b)
-                #     stats[f"added_nodes_{key}"] = added_nodes
-                #     stats[f"removed_nodes_{key}"] = removed_nodes
-
-                # stats_csv.writerow(stats)
-
-                print(f"stats: {stats}")
-                state = transition_input_state
+        def process_block(stats_csv: csv.DictWriter, epochs_ctx: fast_spec.EpochsContext,
+                          state: fast_spec.BeaconState, b: fast_spec.SignedBeaconBlock) -> spec.BeaconState:
+            print("processing block!")
+            start_time = time.time()
+            if state.slot > 500 and (state.slot + 1) % fast_spec.SLOTS_PER_EPOCH == 0:
+                with io.open('pre.ssz', 'bw') as f:
+                    state.serialize(f)
+                with io.open('block.ssz', 'bw') as f:
+                    b.serialize(f)
+                import sys
+                sys.exit(1)
+
+            # Transition in place, no state copy: on failure the state is reverted by swapping the pre-state root back.
+            try:
+                with state_transaction(state):
+                    fast_spec.state_transition(epochs_ctx, state, b)
+            except Exception:
+                traceback.print_exc()
+                print(f"failed to process block at slot {b.message.slot}, reverted to pre-state")
+                # The epochs context may already be rotated by the failed transition
+                epochs_ctx.load_state(state)
+                return state
+
+            end_time = time.time()
+            elapsed_time = end_time - start_time
+            print(f"slot: {state.slot} state root: {state.hash_tree_root().hex()}  processing speed: {1.0 / elapsed_time} blocks / second  ({elapsed_time * 1000.0} ms/block)")
+
+            stats = {
+                'slot': b.message.slot,
+                'proposer': epochs_ctx.get_beacon_proposer(b.message.slot),
+                'process_time': elapsed_time,
+            }
+            # stats_csv.writerow(stats)
+
+            print(f"stats: {stats}")
 
             global morty_status
             morty_status = Status(
@@ -180,33 +139,86 @@ async def lit_morty(rumor: Rumor):
 
             return state
 
-        async def sync_work(stats_csv: csv.DictWriter, state: spec.BeaconState):
+        async def sync_work(stats_csv: csv.DictWriter, state: spec.BeaconState, workers: StateWorkers):
             epochs_ctx = fast_spec.EpochsContext()
             epochs_ctx.load_state(state)
 
-            while True:
-                state = await sync_step(stats_csv, epochs_ctx, state)
-                if state.slot > 10000:
-                    break  # synced enough (TODO: use bootnode status instead)
+            if fixtures_dir is not None:
+                os.makedirs(fixtures_dir, exist_ok=True)
+                with io.open(os.path.join(fixtures_dir, 'state.ssz'), 'bw') as f:
+                    state.serialize(f)
+
+            def copy_head(head):
+                head_state, head_ctx = head
+                return head_state.copy(), head_ctx.copy()
+
+            def advance_head(head, slot):
+                head_state, head_ctx = copy_head(head)
+                epoch_transitions = slot // spec.SLOTS_PER_EPOCH - head_state.slot // spec.SLOTS_PER_EPOCH
+                if epoch_transitions == 0:
+                    fast_spec.process_slots(head_ctx, head_state, slot)
+                    return head_state, head_ctx
+                # Epoch processing runs in a worker process, this thread only waits for the result (without the GIL).
+                head_state = workers.process_slots_sync(head_state, slot)
+                if epoch_transitions == 1:
+                    # Like process_slots does at the epoch boundary
+                    head_ctx.rotate_epochs(head_state)
+                else:
+                    head_ctx.load_state(head_state)
+                return head_state, head_ctx
+
+            lookahead = SlotLookahead(advance_head, copy_head)
+            lag_monitor = LoopLagMonitor()
+
+            def process(b: fast_spec.SignedBeaconBlock):
+                nonlocal state, epochs_ctx
+                if fixtures_dir is not None:
+                    with io.open(os.path.join(fixtures_dir, block_file_name(b.message.slot)), 'bw') as f:
+                        b.serialize(f)
+                # If the parent was advanced to this slot already, only the block itself is left to process.
+                advanced = lookahead.get(b.message.parent_root, b.message.slot)
+                if advanced is None and b.message.slot // spec.SLOTS_PER_EPOCH > state.slot // spec.SLOTS_PER_EPOCH:
+                    # Not prepared (idle rarely runs while range sync keeps up), but the epoch transition
+                    # still goes to a worker process instead of running in this thread.
+                    advanced = advance_head((state, epochs_ctx), b.message.slot)
+                if advanced is not None:
+                    state, epochs_ctx = advanced
+                state = process_block(stats_csv, epochs_ctx, state, b)
+                if state.slot % spec.SLOTS_PER_EPOCH == 0:
+                    print(f"event loop lag: {lag_monitor.summary()}, lookahead hits: {lookahead.hits}, misses: {lookahead.misses}")
+
+            def idle():
+                # Waiting for blocks: advance the head to the next slot (and through the epoch transition).
+                lookahead.prepare(head_block_root(state), (state, epochs_ctx), state.slot + 1)
+
+            # Download and process concurrently: blocks stream into a bounded channel,
+            # while the previous blocks are still being processed.
+            # Batches are spread over all bootnodes, sized by their measured response times.
+            peers = [RumorPeer(morty, peer_id) for peer_id in peer_ids]
+            # Sync up to slot 10000, synced enough (TODO: use bootnode status instead)
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(lag_monitor.run)
+                await sync_blocks(peers, state.slot + 1, 10000, spec.SignedBeaconBlock, process, idle,
+                                  start_parent_root=head_block_root(state))
+                nursery.cancel_scope.cancel()
 
         with open(r'sync_stats.csv', 'a', newline='') as csvfile:
             fieldnames = ['slot', 'proposer', 'process_time']
-            for key in spec.BeaconState.fields().keys():
-                fieldnames.append(f"added_nodes_{key}")
-                fieldnames.append(f"removed_nodes_{key}")
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            await sync_work(writer, state)
+            with StateWorkers('fast_spec', './lighthouse', 'config', bls_active=spec.bls.bls_active) as workers:
+                await sync_work(writer, state, workers)
 
-        print("Saying goobye")
         ok_bye_bye = Goodbye(1)  # A.k.a "Client shut down"
-        await morty.rpc.goodbye.req.raw(peer_id, ok_bye_bye.encode_bytes().hex(), raw=True)
+        for peer_id in peer_ids:
+            print("Saying goobye")
+            await morty.rpc.goodbye.req.raw(peer_id, ok_bye_bye.encode_bytes().hex(), raw=True)
 
-        print("disconnecting")
-        await morty.peer.disconnect(peer_id)
-        print("disconnected")
+            print("disconnecting")
+            await morty.peer.disconnect(peer_id)
+            print("disconnected")
 
-    await sync_from_bootnode(state)
+    await sync_from_bootnodes(state)
 
     # Close the Rumor process
     await rumor.stop()
@@ -218,4 +230,6 @@ async def run_work():
     async with Rumor(cmd='cd ../rumor && go run .') as rumor:
         await lit_morty(rumor)
 
-trio.run(run_work)
+
+if __name__ == '__main__':
+    trio.run(run_work)
@@ -0,0 +1,146 @@
+"""
+Attestation pool: collects attestations by data root, aggregates them, and packs the best ones into blocks.
+
+Aggregation bits are kept as Python ints (bit ``i`` is committee position ``i``), so merging, overlap checks
+and coverage counts are single bitwise operations instead of loops over bitlist views.
+"""
+from heapq import heapify, heappop, heappush
+from typing import Dict, List, Optional, Tuple
+
+import canon_spec as spec
+
+
+def bits_to_int(bits: spec.Bitlist) -> int:
+    """The bits of ``bits`` as an int, from the serialized bitlist without its length delimiter bit."""
+    return int.from_bytes(bits.encode_bytes(), 'little') ^ (1 << len(bits))
+
+
+def int_to_bits(value: int, length: int) -> spec.Bitlist:
+    with_delimiter = value | (1 << length)
+    return spec.Bitlist[spec.MAX_VALIDATORS_PER_COMMITTEE].decode_bytes(
+        with_delimiter.to_bytes(length // 8 + 1, 'little'))
+
+
+def popcount(value: int) -> int:
+    return bin(value).count('1')
+
+
+class PooledAggregate(object):
+    """An aggregate of attestations with the same data, that do not overlap."""
+    bits: int
+    signature: spec.BLSSignature
+
+    def __init__(self, bits: int, signature: spec.BLSSignature):
+        self.bits = bits
+        self.signature = signature
+
+    def merge(self, bits: int, signature: spec.BLSSignature) -> None:
+        assert self.bits & bits == 0
+        self.bits |= bits
+        if spec.bls.bls_active:
+            self.signature = spec.bls.Aggregate([self.signature, signature])
+
+
+class AttestationPool(object):
+    data: Dict[spec.Root, spec.AttestationData]
+    lengths: Dict[spec.Root, int]
+    aggregates: Dict[spec.Root, List[PooledAggregate]]
+
+    def __init__(self):
+        self.data = {}
+        self.lengths = {}
+        self.aggregates = {}
+
+    def __len__(self):
+        return sum(len(aggregates) for aggregates in self.aggregates.values())
+
+    def add(self, attestation: spec.Attestation) -> bool:
+        """
+        Add an attestation, assumed to be valid. It is merged into the first aggregate it does not overlap with.
+        Returns False if it was ignored, since all its bits were already covered by a single aggregate.
+        """
+        data_root = spec.hash_tree_root(attestation.data)
+        bits = bits_to_int(attestation.aggregation_bits)
+        if data_root not in self.data:
+            self.data[data_root] = attestation.data
+            self.lengths[data_root] = len(attestation.aggregation_bits)
+            self.aggregates[data_root] = []
+        aggregates = self.aggregates[data_root]
+        if any(bits & ~aggregate.bits == 0 for aggregate in aggregates):
+            return False
+        # Aggregates that are covered completely by the new attestation are replaced by it
+        aggregates[:] = [aggregate for aggregate in aggregates if aggregate.bits & ~bits != 0]
+        for aggregate in aggregates:
+            if aggregate.bits & bits == 0:
+                aggregate.merge(bits, attestation.signature)
+                return True
+        aggregates.append(PooledAggregate(bits, attestation.signature))
+        return True
+
+    def prune(self, slot: spec.Slot) -> None:
+        """Drop the attestations that can not be included anymore in blocks at ``slot`` or later."""
+        for data_root, data in list(self.data.items()):
+            if data.slot + spec.SLOTS_PER_EPOCH < slot:
+                del self.data[data_root]
+                del self.lengths[data_root]
+                del self.aggregates[data_root]
+
+    def included_bits(self, state: spec.BeaconState) -> Dict[spec.Root, int]:
+        """The bits already included on-chain (in ``state``) per attestation data root."""
+        included = {}
+        for pending in list(state.previous_epoch_attestations) + list(state.current_epoch_attestations):
+            data_root = spec.hash_tree_root(pending.data)
+            if data_root in self.data:
+                included[data_root] = included.get(data_root, 0) | bits_to_int(pending.aggregation_bits)
+        return included
+
+    def is_includable(self, state: spec.BeaconState, data: spec.AttestationData) -> bool:
+        """
+        If an attestation with ``data`` passes the data checks of ``process_attestation``, for a block on ``state``.
+        """
+        if not data.slot + spec.MIN_ATTESTATION_INCLUSION_DELAY <= state.slot <= data.slot + spec.SLOTS_PER_EPOCH:
+            return False
+        if data.target.epoch == spec.get_current_epoch(state):
+            return data.source == state.current_justified_checkpoint
+        if data.target.epoch == spec.get_previous_epoch(state):
+            return data.source == state.previous_justified_checkpoint
+        return False
+
+    def pack(self, state: spec.BeaconState, max_count: Optional[int] = None) -> List[spec.Attestation]:
+        """
+        Pick up to ``MAX_ATTESTATIONS`` aggregates for a block on ``state`` (advanced to the block slot),
+        greedily by the number of attesters they add that are not on-chain or already picked.
+
+        The gain of an aggregate only decreases as others are picked, so gains are re-evaluated lazily:
+        the top of the heap is recomputed, and picked if it is still the best.
+        """
+        if max_count is None:
+            max_count = spec.MAX_ATTESTATIONS
+        covered = self.included_bits(state)
+        heap: List[Tuple[int, int, spec.Root, PooledAggregate]] = []
+        for data_root, aggregates in self.aggregates.items():
+            if not self.is_includable(state, self.data[data_root]):
+                continue
+            for aggregate in aggregates:
+                gain = popcount(aggregate.bits & ~covered.get(data_root, 0))
+                if gain > 0:
+                    heap.append((-gain, len(heap), data_root, aggregate))
+        heapify(heap)
+
+        picked: List[Tuple[spec.Root, PooledAggregate]] = []
+        while len(heap) > 0 and len(picked) < max_count:
+            neg_gain, order, data_root, aggregate = heappop(heap)
+            gain = popcount(aggregate.bits & ~covered.get(data_root, 0))
+            if gain == 0:
+                continue
+            if gain < -neg_gain:
+                heappush(heap, (-gain, order, data_root, aggregate))
+                continue
+            picked.append((data_root, aggregate))
+            covered[data_root] = covered.get(data_root, 0) | aggregate.bits
+
+        return [spec.Attestation(
+            aggregation_bits=int_to_bits(aggregate.bits, self.lengths[data_root]),
+            data=self.data[data_root],
+            signature=aggregate.signature,
+        ) for data_root, aggregate in picked]
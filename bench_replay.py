@@ -0,0 +1,221 @@
+"""
+Replay recorded blocks through fast_spec and/or canon_spec, and report transition latencies, throughput and memory.
+
+Recorded fixtures: a directory with the start state ``state.ssz``, and ``block_<slot>.ssz`` files
+(see ``fixtures_dir`` in ``app.py``). Alternatively, ``--synthetic N`` adds N validators to ``lighthouse/genesis.ssz``,
+and replays empty blocks on top of that, no recordings needed.
+
+Usage: python bench_replay.py [fixtures_dir] [--synthetic N] [--slots N] [--spec fast|canon|both] [--out bench.json]
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from eth2spec.config.config_util import prepare_config
+
+from importlib import reload
+
+import fast_spec
+import canon_spec
+from lookahead import head_block_root
+from packed_lists import packed_array, packed_view
+from sync import list_block_files
+
+# Apply lighthouse config to spec
+prepare_config("./lighthouse", "config")
+reload(fast_spec)
+reload(canon_spec)
+
+# Turn off sig verification
+fast_spec.bls.bls_active = False
+canon_spec.bls.bls_active = False
+
+
+def load_state(filepath: str) -> fast_spec.BeaconState:
+    state_size = os.stat(filepath).st_size
+    with io.open(filepath, 'br') as f:
+        return fast_spec.BeaconState.deserialize(f, state_size)
+
+
+def load_block(filepath: str) -> fast_spec.SignedBeaconBlock:
+    block_size = os.stat(filepath).st_size
+    with io.open(filepath, 'br') as f:
+        return fast_spec.SignedBeaconBlock.deserialize(f, block_size)
+
+
+def recorded_blocks(fixtures_dir: str) -> List[fast_spec.SignedBeaconBlock]:
+    block_files = list_block_files(fixtures_dir)
+    return [load_block(block_files[slot]) for slot in sorted(block_files.keys())]
+
+
+def synthetic_state(genesis_path: str, validator_count: int) -> fast_spec.BeaconState:
+    """Extend the genesis state with ``validator_count`` active validators, with fake pubkeys (BLS is off)."""
+    state = load_state(genesis_path)
+    offset = len(state.validators)
+    new_validators = [fast_spec.Validator(
+        pubkey=fast_spec.BLSPubkey(i.to_bytes(48, 'little')),
+        withdrawal_credentials=fast_spec.Bytes32(i.to_bytes(32, 'little')),
+        effective_balance=fast_spec.MAX_EFFECTIVE_BALANCE,
+        activation_eligibility_epoch=fast_spec.GENESIS_EPOCH,
+        activation_epoch=fast_spec.GENESIS_EPOCH,
+        exit_epoch=fast_spec.FAR_FUTURE_EPOCH,
+        withdrawable_epoch=fast_spec.FAR_FUTURE_EPOCH,
+    ) for i in range(offset, offset + validator_count)]
+    # Both lists are built in bulk, bottom-up, instead of one append (and tree rebind) per validator.
+    state.validators = state.validators.__class__(*(list(state.validators) + new_validators))
+    balances = np.concatenate([
+        packed_array(state.balances),
+        np.full(validator_count, fast_spec.MAX_EFFECTIVE_BALANCE, dtype=np.uint64),
+    ])
+    state.balances = packed_view(state.balances.__class__, balances)
+    # No pending deposits, synthetic blocks do not include any.
+    state.eth1_data.deposit_count = state.eth1_deposit_index
+    return state
+
+
+def synthetic_blocks(spec, slots: int) -> Callable[[object], Iterator]:
+    """Empty blocks, one every slot, built on top of the state as it is being replayed."""
+    def blocks(state) -> Iterator:
+        for _ in range(slots):
+            block = spec.BeaconBlock(
+                slot=state.slot + 1,
+                parent_root=head_block_root(state),
+                body=spec.BeaconBlockBody(eth1_data=state.eth1_data),
+            )
+            yield spec.SignedBeaconBlock(message=block)
+    return blocks
+
+
+def percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    if len(samples) == 0:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000.0,
+        'p50_ms': pick(0.50) * 1000.0,
+        'p90_ms': pick(0.90) * 1000.0,
+        'p99_ms': pick(0.99) * 1000.0,
+        'max_ms': ordered[-1] * 1000.0,
+    }
+
+
+def replay(spec_name: str, pre_state, blocks: Callable[[object], Iterator],
+           validate_result: bool, trace_memory: bool) -> dict:
+    if spec_name == 'fast':
+        state = fast_spec.BeaconState.view_from_backing(pre_state.get_backing())
+        epochs_ctx = fast_spec.EpochsContext()
+        epochs_ctx.load_state(state)
+
+        def process_slots(slot):
+            fast_spec.process_slots(epochs_ctx, state, slot)
+
+        def process_block(signed_block):
+            signed_block = fast_spec.SignedBeaconBlock.view_from_backing(signed_block.get_backing())
+            fast_spec.state_transition(epochs_ctx, state, signed_block, validate_result=validate_result)
+    else:
+        state = canon_spec.BeaconState.view_from_backing(pre_state.get_backing())
+
+        def process_slots(slot):
+            canon_spec.process_slots(state, slot)
+
+        def process_block(signed_block):
+            signed_block = canon_spec.SignedBeaconBlock.view_from_backing(signed_block.get_backing())
+            canon_spec.state_transition(state, signed_block, validate_result=validate_result)
+
+    if trace_memory:
+        tracemalloc.start()
+
+    block_times = []
+    epoch_times = []
+    start = time.perf_counter()
+    for signed_block in blocks(state):
+        slot = signed_block.message.slot
+        crosses_epoch = slot // fast_spec.SLOTS_PER_EPOCH != state.slot // fast_spec.SLOTS_PER_EPOCH
+        block_start = time.perf_counter()
+        # Process slots separately, to measure the epoch transition on its own.
+        process_slots(slot)
+        slots_end = time.perf_counter()
+        process_block(signed_block)
+        block_end = time.perf_counter()
+        block_times.append(block_end - block_start)
+        if crosses_epoch:
+            epoch_times.append(slots_end - block_start)
+        print(f"[{spec_name}] slot {slot}: {(block_end - block_start) * 1000.0:.1f} ms")
+    total = time.perf_counter() - start
+
+    result = {
+        'blocks': len(block_times),
+        'total_s': total,
+        'blocks_per_s': len(block_times) / total if total > 0 else 0.0,
+        'block_latency': percentiles(block_times),
+        'epoch_transition_latency': percentiles(epoch_times),
+        'post_state_root': state.hash_tree_root().hex(),
+        # Process-wide peak, includes everything that ran before in this process.
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if trace_memory:
+        result['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay blocks through fast_spec and canon_spec, and time it.")
+    parser.add_argument('fixtures', nargs='?', default='fixtures',
+                        help="directory with state.ssz and block_<slot>.ssz files")
+    parser.add_argument('--synthetic', type=int, default=None, metavar='N',
+                        help="ignore fixtures, add N validators to the genesis state and replay empty blocks")
+    parser.add_argument('--genesis', default='lighthouse/genesis.ssz', help="genesis state for synthetic mode")
+    parser.add_argument('--slots', type=int, default=3 * 32, help="number of synthetic blocks (one per slot)")
+    parser.add_argument('--limit', type=int, default=None, help="replay at most this many recorded blocks")
+    parser.add_argument('--spec', choices=('fast', 'canon', 'both'), default='both')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="trace allocations with tracemalloc for a per-spec peak (slows down the replay)")
+    parser.add_argument('--out', default='bench.json', help="output JSON file")
+    args = parser.parse_args(args)
+
+    if args.synthetic is not None:
+        print(f"building synthetic state with {args.synthetic} extra validators")
+        pre_state = synthetic_state(args.genesis, args.synthetic)
+        # Synthetic blocks do not commit to a state root
+        validate_result = False
+        blocks_by_spec = {'fast': synthetic_blocks(fast_spec, args.slots),
+                          'canon': synthetic_blocks(canon_spec, args.slots)}
+    else:
+        pre_state = load_state(os.path.join(args.fixtures, 'state.ssz'))
+        validate_result = True
+        recorded = recorded_blocks(args.fixtures)[:args.limit]
+        blocks_by_spec = {'fast': lambda state: iter(recorded), 'canon': lambda state: iter(recorded)}
+
+    report = {
+        'fixtures': None if args.synthetic is not None else args.fixtures,
+        'synthetic_validators': args.synthetic,
+        'validator_count': len(pre_state.validators),
+        'start_slot': int(pre_state.slot),
+        'results': {},
+    }
+    for spec_name in (('fast', 'canon') if args.spec == 'both' else (args.spec,)):
+        print(f"replaying with {spec_name} spec")
+        report['results'][spec_name] = replay(spec_name, pre_state, blocks_by_spec[spec_name],
+                                              validate_result, args.trace_memory)
+
+    with io.open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
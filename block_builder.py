@@ -0,0 +1,69 @@
+"""
+Block production for ``canon_spec``: blocks are built on a head state that is advanced to the block slot ahead of time,
+with attestations packed from an ``AttestationPool``, and the post-state root is computed incrementally.
+"""
+from typing import Optional, Sequence
+
+import canon_spec as spec
+
+from attestation_pool import AttestationPool
+from lookahead import SlotLookahead, head_block_root
+
+
+def advance_state(head_state: spec.BeaconState, slot: spec.Slot) -> spec.BeaconState:
+    state = head_state.copy()
+    spec.process_slots(state, slot)
+    # Hash the advanced state now: the post-state root only has to rehash the paths the block changes.
+    state.hash_tree_root()
+    return state
+
+
+class BlockBuilder(object):
+    attestation_pool: AttestationPool
+    lookahead: SlotLookahead[spec.BeaconState]
+
+    def __init__(self, attestation_pool: AttestationPool,
+                 lookahead: Optional[SlotLookahead[spec.BeaconState]] = None):
+        self.attestation_pool = attestation_pool
+        if lookahead is None:
+            lookahead = SlotLookahead(advance_state, lambda state: state.copy())
+        self.lookahead = lookahead
+
+    def prepare(self, head_state: spec.BeaconState, slot: spec.Slot) -> spec.BeaconState:
+        """
+        The head state advanced to ``slot``, including the epoch transition if there is one.
+        Call it ahead of time, e.g. in the previous slot, to take ``process_slots`` off the block production path.
+        """
+        head_root = head_block_root(head_state)
+        self.lookahead.prepare(head_root, head_state, slot)
+        return self.lookahead.get(head_root, slot)
+
+    def produce_block(self, head_state: spec.BeaconState, slot: spec.Slot,
+                      randao_reveal: spec.BLSSignature, eth1_data: spec.Eth1Data,
+                      graffiti: spec.Bytes32 = spec.Bytes32(),
+                      proposer_slashings: Sequence[spec.ProposerSlashing] = (),
+                      attester_slashings: Sequence[spec.AttesterSlashing] = (),
+                      deposits: Sequence[spec.Deposit] = (),
+                      voluntary_exits: Sequence[spec.SignedVoluntaryExit] = ()) -> spec.BeaconBlock:
+        """
+        Build an unsigned block at ``slot`` on top of ``head_state``, with its state root.
+        The operations other than attestations are included as given, they have to be valid for the block.
+        """
+        state = self.prepare(head_state, slot)
+        block = spec.BeaconBlock(
+            slot=slot,
+            parent_root=spec.hash_tree_root(state.latest_block_header),
+            body=spec.BeaconBlockBody(
+                randao_reveal=randao_reveal,
+                eth1_data=eth1_data,
+                graffiti=graffiti,
+                proposer_slashings=proposer_slashings,
+                attester_slashings=attester_slashings,
+                attestations=self.attestation_pool.pack(state),
+                deposits=deposits,
+                voluntary_exits=voluntary_exits,
+            ),
+        )
+        spec.process_block(state, block)
+        block.state_root = state.hash_tree_root()
+        return block
@@ -1,10 +1,15 @@
 from eth2spec.config.config_util import apply_constants_config
+from bisect import bisect_left, bisect_right
+from heapq import heappop, heappush
+from threading import local
 from typing import (
     Any, Callable, Dict, Set, Sequence, Tuple, Optional, TypeVar
 )
 
 from lru import LRU
 
+import numpy as np
+
 from dataclasses import (
     dataclass,
     field,
@@ -19,6 +24,12 @@ from eth2spec.utils import bls
 
 from eth2spec.utils.hash_function import hash
 
+from remerkleable.tree import RootNode
+
+from deposit_tree import DepositTree
+from packed_lists import bitlist_array, packed_array, packed_view
+from state_accessor import ValidatorRecord, ValidatorRecords
+
 SSZObject = TypeVar('SSZObject', bound=View)
 
 
@@ -1572,6 +1583,7 @@ def cache_this(key_fn, value_fn, lru_size):  # type: ignore
         if key not in cache_dict:
             cache_dict[key] = value_fn(*args, **kw)
         return cache_dict[key]
+    wrapper.cache_clear = cache_dict.clear  # type: ignore
     return wrapper
 
 
@@ -1601,8 +1613,11 @@ get_active_validator_indices = cache_this(
     _get_active_validator_indices, lru_size=3)
 
 _get_beacon_committee = get_beacon_committee
+# Keyed by the seed instead of all randao mixes: a block changes the current mix, not the seeds of its committees
 get_beacon_committee = cache_this(
-    lambda state, slot, index: (state.validators.hash_tree_root(), state.randao_mixes.hash_tree_root(), slot, index),
+    lambda state, slot, index: (
+        state.validators.hash_tree_root(),
+        get_seed(state, compute_epoch_at_slot(slot), DOMAIN_BEACON_ATTESTER), slot, index),
     _get_beacon_committee, lru_size=SLOTS_PER_EPOCH * MAX_COMMITTEES_PER_SLOT * 3)
 
 _get_matching_target_attestations = get_matching_target_attestations
@@ -1619,3 +1634,1023 @@ _get_attesting_indices = get_attesting_indices
 get_attesting_indices = cache_this(
     lambda state, data, bits: (state.validators.hash_tree_root(), data.hash_tree_root(), bits.hash_tree_root()),
     _get_attesting_indices, lru_size=SLOTS_PER_EPOCH * MAX_COMMITTEES_PER_SLOT * 3)
+
+
+def process_empty_slots(state: BeaconState, end_slot: Slot) -> None:
+    """
+    Process the slots from ``state.slot`` up to (excluding) ``end_slot``, none of which may be an epoch boundary.
+    After the first slot, the latest block header is final, so the block root is the same for the whole run:
+    only the state root has to be computed for each slot. The writes to ``slot``, ``state_roots`` and ``block_roots``
+    go straight into the backing, without intermediate views.
+    """
+    process_slot(state)
+    state.slot += Slot(1)
+    if state.slot >= end_slot:
+        return
+
+    block_root_node = RootNode(hash_tree_root(state.latest_block_header))
+    fields = list(BeaconState.fields().keys())
+    container_depth = BeaconState.tree_depth()
+    slot_gindex = 2**container_depth + fields.index('slot')
+    block_roots_gindex = 2**container_depth + fields.index('block_roots')
+    state_roots_gindex = 2**container_depth + fields.index('state_roots')
+    roots_depth = BeaconState.fields()['state_roots'].tree_depth()
+
+    backing = state.get_backing()
+    block_roots = backing.getter(block_roots_gindex)
+    state_roots = backing.getter(state_roots_gindex)
+    for slot in range(state.slot, end_slot):
+        root_gindex = 2**roots_depth + slot % SLOTS_PER_HISTORICAL_ROOT
+        state_roots = state_roots.setter(root_gindex)(RootNode(backing.merkle_root()))
+        block_roots = block_roots.setter(root_gindex)(block_root_node)
+        backing = backing.setter(state_roots_gindex)(state_roots)
+        backing = backing.setter(block_roots_gindex)(block_roots)
+        backing = backing.setter(slot_gindex)(RootNode((slot + 1).to_bytes(32, ENDIANNESS)))
+    state.set_backing(backing)
+
+
+def process_slots_skip(state: BeaconState, slot: Slot) -> None:
+    assert state.slot <= slot
+    while state.slot < slot:
+        # Up to the last slot of the epoch no epoch processing is needed: skip through those in one run
+        last_slot_of_epoch = state.slot - state.slot % SLOTS_PER_EPOCH + SLOTS_PER_EPOCH - 1
+        run_end = min(slot, last_slot_of_epoch)
+        if state.slot < run_end:
+            process_empty_slots(state, Slot(run_end))
+        else:
+            process_slot(state)
+            # Process epoch on the start slot of the next epoch
+            if (state.slot + 1) % SLOTS_PER_EPOCH == 0:
+                process_epoch(state)
+            state.slot += Slot(1)
+
+
+_process_slots = process_slots
+process_slots = process_slots_skip
+
+
+@dataclass(frozen=True)
+class CommitteeAssignment(object):
+    committee: Sequence[ValidatorIndex]
+    committee_index: CommitteeIndex
+    slot: Slot
+    position: int  # Position of the validator in the committee
+
+
+def compute_duty_index(state: BeaconState, epoch: Epoch) -> Dict[ValidatorIndex, CommitteeAssignment]:
+    """
+    Return the committee assignment of every validator with a duty in ``epoch``, keyed by validator index.
+    """
+    duty_index = {}
+    start_slot = compute_start_slot_at_epoch(epoch)
+    for slot in range(start_slot, start_slot + SLOTS_PER_EPOCH):
+        for index in range(get_committee_count_at_slot(state, Slot(slot))):
+            committee = get_beacon_committee(state, Slot(slot), CommitteeIndex(index))
+            for position, validator_index in enumerate(committee):
+                duty_index[validator_index] = CommitteeAssignment(committee, CommitteeIndex(index), Slot(slot), position)
+    return duty_index
+
+
+# Keyed by the seed instead of all randao mixes, like get_beacon_committee: every block changes the current mix
+_get_duty_index_cached = cache_this(
+    lambda state, epoch: (
+        state.validators.hash_tree_root(), get_seed(state, epoch, DOMAIN_BEACON_ATTESTER), epoch),
+    compute_duty_index, lru_size=3)
+
+
+def get_duty_index(state: BeaconState, epoch: Epoch) -> Dict[ValidatorIndex, CommitteeAssignment]:
+    # Checked before the cache: a cached index of an epoch out of range must not be returned either
+    next_epoch = get_current_epoch(state) + 1
+    assert epoch <= next_epoch
+    return _get_duty_index_cached(state, epoch)
+
+
+def get_committee_assignments(state: BeaconState,
+                              epoch: Epoch,
+                              validator_indices: Sequence[ValidatorIndex]
+                              ) -> Sequence[Optional[CommitteeAssignment]]:
+    """
+    Return the committee assignments in the ``epoch`` for all ``validator_indices`` at once,
+    None for the validators without assignment.
+    """
+    duty_index = get_duty_index(state, epoch)
+    return [duty_index.get(validator_index) for validator_index in validator_indices]
+
+
+def compute_epoch_proposers(state: BeaconState, epoch: Epoch) -> Sequence[ValidatorIndex]:
+    """
+    Return the proposer of every slot in ``epoch``, which must be the current epoch:
+    proposers depend on the effective balances, which only settle at the start of the epoch.
+    """
+    indices = get_active_validator_indices(state, epoch)
+    epoch_seed = get_seed(state, epoch, DOMAIN_BEACON_PROPOSER)
+    start_slot = compute_start_slot_at_epoch(epoch)
+    return [
+        compute_proposer_index(state, indices, hash(epoch_seed + int_to_bytes(slot, length=8)))
+        for slot in range(start_slot, start_slot + SLOTS_PER_EPOCH)
+    ]
+
+
+_get_epoch_proposers_cached = cache_this(
+    lambda state, epoch: (
+        state.validators.hash_tree_root(), epoch, get_seed(state, epoch, DOMAIN_BEACON_PROPOSER)),
+    compute_epoch_proposers, lru_size=3)
+
+
+def get_epoch_proposers(state: BeaconState, epoch: Epoch) -> Sequence[ValidatorIndex]:
+    # Checked before the cache, like get_duty_index
+    assert epoch == get_current_epoch(state)
+    return _get_epoch_proposers_cached(state, epoch)
+
+
+def get_committee_assignment_indexed(state: BeaconState,
+                                     epoch: Epoch,
+                                     validator_index: ValidatorIndex
+                                     ) -> Optional[Tuple[Sequence[ValidatorIndex], CommitteeIndex, Slot]]:
+    assignment = get_duty_index(state, epoch).get(validator_index)
+    if assignment is None:
+        return None
+    return assignment.committee, assignment.committee_index, assignment.slot
+
+
+_get_committee_assignment = get_committee_assignment
+get_committee_assignment = get_committee_assignment_indexed
+
+
+def get_slot_signatures(state: BeaconState,
+                        epoch: Epoch,
+                        privkeys: Dict[ValidatorIndex, int]) -> Sequence[Tuple[ValidatorIndex, BLSSignature]]:
+    """
+    Sign the assigned slot in ``epoch`` for every validator in ``privkeys`` that has an assignment.
+    The domain is computed once for the epoch, instead of once per validator.
+    """
+    duty_index = get_duty_index(state, epoch)
+    domain = get_domain(state, DOMAIN_BEACON_ATTESTER, epoch)
+    return [
+        (validator_index, bls.Sign(privkey, compute_signing_root(duty_index[validator_index].slot, domain)))
+        for validator_index, privkey in privkeys.items() if validator_index in duty_index
+    ]
+
+
+def get_aggregators(state: BeaconState,
+                    epoch: Epoch,
+                    slot_signatures: Sequence[Tuple[ValidatorIndex, BLSSignature]]) -> Set[ValidatorIndex]:
+    """
+    Return the validators that are aggregators of their committee in ``epoch``,
+    given their slot signatures (see ``get_slot_signatures``). Validators without an assignment are ignored.
+    The gain over ``is_aggregator`` comes from the duty index: committees are not recomputed per validator,
+    the moduli come from the cached committee sizes. The selection proofs are still hashed one by one.
+    A ``TARGET_AGGREGATORS_PER_COMMITTEE`` of 0 (e.g. the lighthouse testnet config) is treated as 1.
+    """
+    duty_index = get_duty_index(state, epoch)
+    target = max(1, TARGET_AGGREGATORS_PER_COMMITTEE)
+    aggregators = set()
+    for validator_index, slot_signature in slot_signatures:
+        assignment = duty_index.get(validator_index)
+        if assignment is None:
+            continue
+        modulo = max(1, len(assignment.committee) // target)
+        if bytes_to_int(hash(slot_signature)[0:8]) % modulo == 0:
+            aggregators.add(validator_index)
+    return aggregators
+
+
+class Eth1VoteTracker(object):
+    """Running counts of the eth1 data votes in the current voting period, keyed by vote root."""
+    counts: Dict[Root, int]
+    first_index: Dict[Root, int]  # Index of the first occurrence, for tie-breaking
+    votes: Dict[Root, Eth1Data]
+    length: int
+
+    def __init__(self, votes: Sequence[Eth1Data] = ()):
+        self.counts = {}
+        self.first_index = {}
+        self.votes = {}
+        self.length = 0
+        for vote in votes:
+            self.add(vote)
+
+    def add(self, vote: Eth1Data) -> int:
+        """Count ``vote``, and return its new count."""
+        key = hash_tree_root(vote)
+        if key not in self.counts:
+            self.counts[key] = 0
+            self.first_index[key] = self.length
+            self.votes[key] = vote
+        self.counts[key] += 1
+        self.length += 1
+        return self.counts[key]
+
+    def copy(self) -> "Eth1VoteTracker":
+        tracker = Eth1VoteTracker()
+        tracker.counts = dict(self.counts)
+        tracker.first_index = dict(self.first_index)
+        tracker.votes = dict(self.votes)
+        tracker.length = self.length
+        return tracker
+
+
+# Trackers are keyed by the root of the votes list they count. A new vote is counted in a copy, kept for the new root,
+# other states with the old votes, e.g. the pre-state of a speculative block, still find theirs.
+# The empty list of a new voting period starts an empty tracker.
+_eth1_vote_trackers = LRU(size=16)
+
+
+def get_eth1_vote_tracker(state: BeaconState) -> Eth1VoteTracker:
+    key = hash_tree_root(state.eth1_data_votes)
+    if key not in _eth1_vote_trackers:
+        _eth1_vote_trackers[key] = Eth1VoteTracker(state.eth1_data_votes)
+    return _eth1_vote_trackers[key]
+
+
+def process_eth1_data_tracked(state: BeaconState, body: BeaconBlockBody) -> None:
+    tracker = get_eth1_vote_tracker(state).copy()
+    state.eth1_data_votes.append(body.eth1_data)
+    vote_count = tracker.add(body.eth1_data)
+    _eth1_vote_trackers[hash_tree_root(state.eth1_data_votes)] = tracker
+    if vote_count * 2 > SLOTS_PER_ETH1_VOTING_PERIOD:
+        state.eth1_data = body.eth1_data
+
+
+_process_eth1_data = process_eth1_data
+process_eth1_data = process_eth1_data_tracked
+
+
+class Eth1ChainIndex(object):
+    """Eth1 blocks sorted by ascending block height, indexed by timestamp. New blocks can be appended."""
+    blocks: Sequence[Eth1Block]
+    timestamps: Sequence[int]
+
+    def __init__(self, eth1_chain: Sequence[Eth1Block] = ()):
+        self.blocks = []
+        self.timestamps = []
+        for block in eth1_chain:
+            self.append(block)
+
+    def append(self, block: Eth1Block) -> None:
+        assert len(self.timestamps) == 0 or block.timestamp >= self.timestamps[-1]
+        self.blocks.append(block)
+        self.timestamps.append(int(block.timestamp))
+
+    def candidate_blocks(self, period_start: uint64) -> Sequence[Eth1Block]:
+        """Same as filtering with ``is_candidate_block``, but by bisection on the timestamps."""
+        follow_time = SECONDS_PER_ETH1_BLOCK * ETH1_FOLLOW_DISTANCE
+        start = bisect_left(self.timestamps, int(period_start) - follow_time * 2)
+        end = bisect_right(self.timestamps, int(period_start) - follow_time)
+        return self.blocks[start:end]
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def __getitem__(self, i):
+        return self.blocks[i]
+
+
+def get_eth1_vote_indexed(state: BeaconState, eth1_chain: Sequence[Eth1Block]) -> Eth1Data:
+    if not isinstance(eth1_chain, Eth1ChainIndex):
+        eth1_chain = Eth1ChainIndex(eth1_chain)
+    period_start = voting_period_start_time(state)
+    votes_to_consider = [get_eth1_data(block) for block in eth1_chain.candidate_blocks(period_start)]
+    candidate_keys = set(hash_tree_root(vote) for vote in votes_to_consider)
+
+    # Default vote on latest eth1 block data in the period range unless eth1 chain is not live
+    default_vote = votes_to_consider[-1] if any(votes_to_consider) else state.eth1_data
+
+    # Valid votes already cast during this period, straight from the running counts
+    tracker = get_eth1_vote_tracker(state)
+    valid_keys = [key for key in tracker.counts.keys() if key in candidate_keys]
+    if len(valid_keys) == 0:
+        return default_vote
+    # Tiebreak by smallest distance
+    best_key = max(valid_keys, key=lambda key: (tracker.counts[key], -tracker.first_index[key]))
+    return tracker.votes[best_key]
+
+
+_get_eth1_vote = get_eth1_vote
+get_eth1_vote = get_eth1_vote_indexed
+
+
+def is_valid_deposit_multiproof(leaves: Sequence[Bytes32], branches: Sequence[Sequence[Bytes32]],
+                                start_index: uint64, root: Root) -> bool:
+    """
+    Check if the consecutive ``leaves`` at ``start_index`` verify against the Merkle ``root``,
+    each with their own ``branch``, like ``is_valid_merkle_branch`` does for each of them.
+
+    The tree is computed bottom-up once from all leaves, with the siblings outside of the leaves range taken from
+    the first and last branch. Shared internal nodes are hashed only once, every branch is then checked by
+    comparing it against the computed siblings, level by level, which needs no hashing.
+    """
+    count = len(leaves)
+    assert count == len(branches) and count > 0
+    depth = DEPOSIT_CONTRACT_TREE_DEPTH
+    nodes = {start_index + i: leaf for i, leaf in enumerate(leaves)}
+    start, end = start_index, start_index + count - 1  # Range of nodes at the current level
+    for level in range(depth):
+        # Siblings outside of the range come from the branches of the first and last leaf
+        if start % 2 == 1:
+            nodes[start - 1] = branches[0][level]
+        if end % 2 == 0:
+            nodes[end + 1] = branches[-1][level]
+        for i, branch in enumerate(branches):
+            if branch[level] != nodes[((start_index + i) >> level) ^ 1]:
+                return False
+        start, end = start >> 1, end >> 1
+        nodes = {i: hash(nodes[i * 2] + nodes[i * 2 + 1]) for i in range(start, end + 1)}
+    # Mix in the length of the deposits list
+    mix_in = branches[0][depth]
+    if any(branch[depth] != mix_in for branch in branches):
+        return False
+    return hash(nodes[0] + mix_in) == root
+
+
+def apply_deposit(state: BeaconState, deposit: Deposit) -> None:
+    """``process_deposit``, after the Merkle branch is verified."""
+    # Deposits must be processed in order
+    state.eth1_deposit_index += 1
+
+    pubkey = deposit.data.pubkey
+    amount = deposit.data.amount
+    validator_pubkeys = [v.pubkey for v in state.validators]
+    if pubkey not in validator_pubkeys:
+        # Verify the deposit signature (proof of possession) which is not checked by the deposit contract
+        deposit_message = DepositMessage(
+            pubkey=deposit.data.pubkey,
+            withdrawal_credentials=deposit.data.withdrawal_credentials,
+            amount=deposit.data.amount,
+        )
+        domain = compute_domain(DOMAIN_DEPOSIT)  # Fork-agnostic domain since deposits are valid across forks
+        signing_root = compute_signing_root(deposit_message, domain)
+        if not bls.Verify(pubkey, signing_root, deposit.data.signature):
+            return
+
+        # Add validator and balance entries
+        state.validators.append(Validator(
+            pubkey=pubkey,
+            withdrawal_credentials=deposit.data.withdrawal_credentials,
+            activation_eligibility_epoch=FAR_FUTURE_EPOCH,
+            activation_epoch=FAR_FUTURE_EPOCH,
+            exit_epoch=FAR_FUTURE_EPOCH,
+            withdrawable_epoch=FAR_FUTURE_EPOCH,
+            effective_balance=min(amount - amount % EFFECTIVE_BALANCE_INCREMENT, MAX_EFFECTIVE_BALANCE),
+        ))
+        state.balances.append(amount)
+    else:
+        # Increase balance by deposit amount
+        index = ValidatorIndex(validator_pubkeys.index(pubkey))
+        increase_balance(state, index, amount)
+
+
+def process_deposits(state: BeaconState, deposits: Sequence[Deposit]) -> None:
+    """Process all deposits of a block, verifying all their Merkle branches at once."""
+    if len(deposits) == 0:
+        return
+    assert is_valid_deposit_multiproof(
+        leaves=[hash_tree_root(deposit.data) for deposit in deposits],
+        branches=[deposit.proof for deposit in deposits],
+        start_index=state.eth1_deposit_index,
+        root=state.eth1_data.deposit_root,
+    )
+    for deposit in deposits:
+        apply_deposit(state, deposit)
+
+
+def process_deposit_multiproof(state: BeaconState, deposit: Deposit) -> None:
+    process_deposits(state, [deposit])
+
+
+_process_deposit = process_deposit
+process_deposit = process_deposit_multiproof
+
+
+def process_operations_batched_deposits(state: BeaconState, body: BeaconBlockBody) -> None:
+    # Verify that outstanding deposits are processed up to the maximum number of deposits
+    assert len(body.deposits) == min(MAX_DEPOSITS, state.eth1_data.deposit_count - state.eth1_deposit_index)
+
+    for operations, function in (
+            (body.proposer_slashings, process_proposer_slashing),
+            (body.attester_slashings, process_attester_slashing),
+            (body.attestations, process_attestation),
+    ):
+        for operation in operations:
+            function(state, operation)
+    # All deposits are verified against the same deposit root, in one multi-proof
+    process_deposits(state, body.deposits)
+    for operation in body.voluntary_exits:
+        process_voluntary_exit(state, operation)
+
+
+_process_operations = process_operations
+process_operations = process_operations_batched_deposits
+
+
+def initialize_beacon_state_from_eth1_bulk(eth1_block_hash: Bytes32,
+                                           eth1_timestamp: uint64,
+                                           deposits: Sequence[Deposit]) -> BeaconState:
+    """
+    Same genesis state as ``initialize_beacon_state_from_eth1``, built in bulk: the deposit root is tracked with an
+    incremental ``DepositTree``, pubkeys are looked up in a dict, and the registry is built once at the end,
+    instead of one tree write per validator.
+    """
+    fork = Fork(
+        previous_version=GENESIS_FORK_VERSION,
+        current_version=GENESIS_FORK_VERSION,
+        epoch=GENESIS_EPOCH,
+    )
+    state = BeaconState(
+        genesis_time=eth1_timestamp - eth1_timestamp % MIN_GENESIS_DELAY + 2 * MIN_GENESIS_DELAY,
+        fork=fork,
+        eth1_data=Eth1Data(block_hash=eth1_block_hash, deposit_count=len(deposits)),
+        latest_block_header=BeaconBlockHeader(body_root=hash_tree_root(BeaconBlockBody())),
+        randao_mixes=[eth1_block_hash] * EPOCHS_PER_HISTORICAL_VECTOR,  # Seed RANDAO with Eth1 entropy
+    )
+
+    # Process deposits
+    tree = DepositTree(DEPOSIT_CONTRACT_TREE_DEPTH)
+    validator_indices: Dict[BLSPubkey, ValidatorIndex] = {}
+    deposit_data = []
+    balances = []
+    for deposit in deposits:
+        data = deposit.data
+        tree.append(hash_tree_root(data))
+        # The deposit proves the last leaf against the root as it is after appending it.
+        # The branch must be the one of the tree, equivalent to is_valid_merkle_branch against tree.root()
+        assert list(deposit.proof) == tree.last_proof()
+        if data.pubkey not in validator_indices:
+            deposit_message = DepositMessage(
+                pubkey=data.pubkey,
+                withdrawal_credentials=data.withdrawal_credentials,
+                amount=data.amount,
+            )
+            domain = compute_domain(DOMAIN_DEPOSIT)
+            signing_root = compute_signing_root(deposit_message, domain)
+            if not bls.Verify(data.pubkey, signing_root, data.signature):
+                continue
+            validator_indices[data.pubkey] = ValidatorIndex(len(deposit_data))
+            deposit_data.append(data)
+            balances.append(data.amount)
+        else:
+            balances[validator_indices[data.pubkey]] += data.amount
+    state.eth1_data.deposit_root = tree.root()
+    state.eth1_deposit_index = len(deposits)
+
+    # Process activations, with the final balances
+    validators = []
+    for data, balance in zip(deposit_data, balances):
+        effective_balance = min(balance - balance % EFFECTIVE_BALANCE_INCREMENT, MAX_EFFECTIVE_BALANCE)
+        activation_epoch = GENESIS_EPOCH if effective_balance == MAX_EFFECTIVE_BALANCE else FAR_FUTURE_EPOCH
+        validators.append(Validator(
+            pubkey=data.pubkey,
+            withdrawal_credentials=data.withdrawal_credentials,
+            activation_eligibility_epoch=activation_epoch,
+            activation_epoch=activation_epoch,
+            exit_epoch=FAR_FUTURE_EPOCH,
+            withdrawable_epoch=FAR_FUTURE_EPOCH,
+            effective_balance=effective_balance,
+        ))
+    state.validators = validators
+    state.balances = balances
+
+    return state
+
+
+_initialize_beacon_state_from_eth1 = initialize_beacon_state_from_eth1
+initialize_beacon_state_from_eth1 = initialize_beacon_state_from_eth1_bulk
+
+
+def get_balances_array(state: BeaconState) -> np.ndarray:
+    """All balances as a uint64 array, read from the leaf chunks of the packed list."""
+    return packed_array(state.balances)
+
+
+def set_balances_array(state: BeaconState, balances: np.ndarray) -> None:
+    """Replace all balances with ``balances``, building the packed list backing at once instead of per element writes."""
+    state.balances = packed_view(state.balances.__class__, balances)
+
+
+def process_rewards_and_penalties_vectorized(state: BeaconState) -> None:
+    if get_current_epoch(state) == GENESIS_EPOCH:
+        return
+
+    rewards, penalties = get_attestation_deltas(state)
+    balances = get_balances_array(state)
+    increased = balances + np.array(rewards, dtype=np.uint64)
+    # NumPy wraps around, increase_balance raises: fail the same way
+    overflows = np.flatnonzero(increased < balances)
+    if len(overflows) > 0:
+        raise ValueError(f"balance of validator {overflows[0]} out of bounds for {Gwei}")
+    balances = increased
+    penalties = np.array(penalties, dtype=np.uint64)
+    # Decrease with underflow protection, like decrease_balance
+    balances = np.where(penalties > balances, np.uint64(0), balances - penalties)
+    set_balances_array(state, balances)
+
+
+_process_rewards_and_penalties = process_rewards_and_penalties
+process_rewards_and_penalties = process_rewards_and_penalties_vectorized
+
+
+def process_effective_balance_updates(state: BeaconState) -> None:
+    """Update effective balances with hysteresis, computed for all validators at once. Only changes are written."""
+    balances = get_balances_array(state)
+    effective_balances = np.fromiter((record.effective_balance for record in get_validator_records(state)),
+                                     dtype=np.uint64, count=len(balances))
+    HALF_INCREMENT = EFFECTIVE_BALANCE_INCREMENT // 2
+    update = (balances < effective_balances) | (effective_balances + np.uint64(3 * HALF_INCREMENT) < balances)
+    new_effective_balances = np.minimum(balances - balances % np.uint64(EFFECTIVE_BALANCE_INCREMENT),
+                                        np.uint64(MAX_EFFECTIVE_BALANCE))
+    changed = np.flatnonzero(update & (new_effective_balances != effective_balances))
+    if len(changed) == 0:
+        return
+    registry = take_registry_index(state)
+    for index in changed.tolist():
+        validator = state.validators[index]
+        validator.effective_balance = Gwei(int(new_effective_balances[index]))
+        registry.update(ValidatorIndex(index), validator)
+    keep_registry_index(state, registry)
+
+
+def process_final_updates_vectorized(state: BeaconState) -> None:
+    current_epoch = get_current_epoch(state)
+    next_epoch = Epoch(current_epoch + 1)
+    # Reset eth1 data votes
+    if (state.slot + 1) % SLOTS_PER_ETH1_VOTING_PERIOD == 0:
+        state.eth1_data_votes = []
+    # Update effective balances with hysteresis
+    process_effective_balance_updates(state)
+    # Reset slashings
+    set_slashings(state, next_epoch % EPOCHS_PER_SLASHINGS_VECTOR, Gwei(0))
+    # Set randao mix
+    state.randao_mixes[next_epoch % EPOCHS_PER_HISTORICAL_VECTOR] = get_randao_mix(state, current_epoch)
+    # Set historical root accumulator
+    if next_epoch % (SLOTS_PER_HISTORICAL_ROOT // SLOTS_PER_EPOCH) == 0:
+        historical_batch = HistoricalBatch(block_roots=state.block_roots, state_roots=state.state_roots)
+        state.historical_roots.append(hash_tree_root(historical_batch))
+    # Rotate current/previous epoch attestations
+    state.previous_epoch_attestations = state.current_epoch_attestations
+    state.current_epoch_attestations = []
+
+
+_process_final_updates = process_final_updates
+process_final_updates = process_final_updates_vectorized
+
+
+class RegistryIndex(object):
+    """
+    Index of the validator registry for epoch processing, maintained as validators change:
+    the activation queue, the validators waiting to be placed in it, and the ejection candidates.
+    """
+    # Heap of (activation_eligibility_epoch, index) of the validators that are queued and not activated yet
+    activation_queue: Sequence[Tuple[Epoch, ValidatorIndex]]
+    # Validators that are eligible for the activation queue, see is_eligible_for_activation_queue
+    pending_eligibility: Set[ValidatorIndex]
+    # Validators with an ejection balance that did not initiate an exit yet, possibly not active yet
+    ejection_candidates: Set[ValidatorIndex]
+    # The last exit epoch of the exit queue, and the number of validators exiting in it. Exits are never queued
+    # before the last exit epoch, so the churn of earlier epochs is not needed.
+    max_exit_epoch: Epoch
+    max_exit_epoch_churn: uint64
+    # Slashed validators by withdrawable epoch, for the slashing penalties half-way through the slashings vector
+    slashing_schedule: Dict[Epoch, Sequence[ValidatorIndex]]
+    # Due epochs up to here may have been dropped from the schedule after processing, see process_slashings_scheduled
+    slashing_schedule_pruned: Epoch
+
+    def __init__(self, validators: Sequence[Validator] = ()):
+        self.activation_queue = []
+        self.pending_eligibility = set()
+        self.ejection_candidates = set()
+        self.max_exit_epoch = GENESIS_EPOCH
+        self.max_exit_epoch_churn = 0
+        self.slashing_schedule = {}
+        self.slashing_schedule_pruned = GENESIS_EPOCH
+        for index, validator in enumerate(validators):
+            self.add(ValidatorIndex(index), validator)
+
+    def add(self, index: ValidatorIndex, validator: Validator) -> None:
+        if (validator.activation_eligibility_epoch != FAR_FUTURE_EPOCH
+                and validator.activation_epoch == FAR_FUTURE_EPOCH):
+            heappush(self.activation_queue, (validator.activation_eligibility_epoch, index))
+        if validator.exit_epoch != FAR_FUTURE_EPOCH:
+            self.add_exit(validator.exit_epoch)
+        if validator.slashed:
+            self.add_slashed(index, validator.withdrawable_epoch)
+        self.update(index, validator)
+
+    def add_exit(self, exit_epoch: Epoch) -> None:
+        if exit_epoch > self.max_exit_epoch:
+            self.max_exit_epoch = exit_epoch
+            self.max_exit_epoch_churn = 1
+        elif exit_epoch == self.max_exit_epoch:
+            self.max_exit_epoch_churn += 1
+
+    def add_slashed(self, index: ValidatorIndex, withdrawable_epoch: Epoch) -> None:
+        self.slashing_schedule.setdefault(withdrawable_epoch, []).append(index)
+
+    def update(self, index: ValidatorIndex, validator: Validator) -> None:
+        """Update the index after the effective balance or exit epoch of ``validator`` changed."""
+        if is_eligible_for_activation_queue(validator):
+            self.pending_eligibility.add(index)
+        else:
+            self.pending_eligibility.discard(index)
+        if validator.exit_epoch == FAR_FUTURE_EPOCH and validator.effective_balance <= EJECTION_BALANCE:
+            self.ejection_candidates.add(index)
+        else:
+            self.ejection_candidates.discard(index)
+
+    def copy(self) -> "RegistryIndex":
+        registry = RegistryIndex()
+        registry.activation_queue = list(self.activation_queue)
+        registry.pending_eligibility = set(self.pending_eligibility)
+        registry.ejection_candidates = set(self.ejection_candidates)
+        registry.max_exit_epoch = self.max_exit_epoch
+        registry.max_exit_epoch_churn = self.max_exit_epoch_churn
+        registry.slashing_schedule = {epoch: list(indices) for epoch, indices in self.slashing_schedule.items()}
+        registry.slashing_schedule_pruned = self.slashing_schedule_pruned
+        return registry
+
+
+# Registry indices are keyed by the root of the validators they index, and are never modified once in here:
+# states with the same registry, also in other threads (blocks may be produced or advanced there), share them.
+# The first change in a block or epoch transition updates a copy, kept for the new root in the thread of the
+# transition only. Later changes in the same transition update that copy again, and the end of the transition
+# publishes it here.
+_registry_indices = LRU(size=8)
+
+# (validators root, registry index) of the transition running in this thread, see take_registry_index
+_transition_registry = local()
+
+
+def get_registry_index(state: BeaconState) -> RegistryIndex:
+    key = state.validators.hash_tree_root()
+    if getattr(_transition_registry, 'key', None) == key:
+        return _transition_registry.registry
+    if key not in _registry_indices:
+        _registry_indices[key] = RegistryIndex(state.validators)
+    return _registry_indices[key]
+
+
+def take_registry_index(state: BeaconState) -> RegistryIndex:
+    """The registry index, to update along with changes to ``state.validators``: a copy once per transition."""
+    if getattr(_transition_registry, 'key', None) == state.validators.hash_tree_root():
+        # Already copied in this transition, no other state or thread has it
+        registry = _transition_registry.registry
+        del _transition_registry.key, _transition_registry.registry
+        return registry
+    return get_registry_index(state).copy()
+
+
+def keep_registry_index(state: BeaconState, registry: RegistryIndex) -> None:
+    """Put the updated registry index back, for the current ``state.validators``, private to this thread."""
+    _transition_registry.key = state.validators.hash_tree_root()
+    _transition_registry.registry = registry
+
+
+def freeze_registry_index(state: BeaconState) -> None:
+    """End of a transition: publish the index of ``state``, from here on it is shared and the next change copies it."""
+    key = state.validators.hash_tree_root()
+    if getattr(_transition_registry, 'key', None) == key:
+        _registry_indices[key] = _transition_registry.registry
+        del _transition_registry.key, _transition_registry.registry
+
+
+_process_block = process_block
+
+
+def process_block_frozen_registry(state: BeaconState, block: BeaconBlock) -> None:
+    _process_block(state, block)
+    freeze_registry_index(state)
+
+
+process_block = process_block_frozen_registry
+
+
+_process_epoch = process_epoch
+
+
+def process_epoch_frozen_registry(state: BeaconState) -> None:
+    _process_epoch(state)
+    freeze_registry_index(state)
+
+
+process_epoch = process_epoch_frozen_registry
+
+
+_initiate_validator_exit = initiate_validator_exit
+
+
+def initiate_validator_exit_indexed(state: BeaconState, index: ValidatorIndex) -> None:
+    # Return if validator already initiated exit
+    validator = state.validators[index]
+    if validator.exit_epoch != FAR_FUTURE_EPOCH:
+        return
+
+    # Compute exit queue epoch, from the tracked end of the exit queue instead of all exit epochs
+    registry = take_registry_index(state)
+    exit_queue_epoch = max(registry.max_exit_epoch, compute_activation_exit_epoch(get_current_epoch(state)))
+    exit_queue_churn = registry.max_exit_epoch_churn if exit_queue_epoch == registry.max_exit_epoch else 0
+    if exit_queue_churn >= get_validator_churn_limit(state):
+        exit_queue_epoch += Epoch(1)
+
+    # Set validator exit epoch and withdrawable epoch
+    validator.exit_epoch = exit_queue_epoch
+    validator.withdrawable_epoch = Epoch(validator.exit_epoch + MIN_VALIDATOR_WITHDRAWABILITY_DELAY)
+    registry.add_exit(exit_queue_epoch)
+    registry.update(index, validator)
+    keep_registry_index(state, registry)
+
+
+initiate_validator_exit = initiate_validator_exit_indexed
+
+
+_apply_deposit = apply_deposit
+
+
+def apply_deposit_indexed(state: BeaconState, deposit: Deposit) -> None:
+    registry = take_registry_index(state)
+    validator_count = len(state.validators)
+    _apply_deposit(state, deposit)
+    # Top-ups and deposits with an invalid signature do not change the registry
+    for index in range(validator_count, len(state.validators)):
+        registry.add(ValidatorIndex(index), state.validators[index])
+    keep_registry_index(state, registry)
+
+
+apply_deposit = apply_deposit_indexed
+
+
+def process_registry_updates_indexed(state: BeaconState) -> None:
+    current_epoch = get_current_epoch(state)
+    registry = take_registry_index(state)
+    # Process activation eligibility: the validators that became eligible since the last epoch
+    for index in sorted(registry.pending_eligibility):
+        state.validators[index].activation_eligibility_epoch = current_epoch + 1
+        heappush(registry.activation_queue, (Epoch(current_epoch + 1), index))
+    registry.pending_eligibility.clear()
+    keep_registry_index(state, registry)
+
+    # Process ejections, in index order, since exits are queued
+    for index in sorted(registry.ejection_candidates):
+        if is_active_validator(state.validators[index], current_epoch):
+            initiate_validator_exit(state, index)
+
+    # Dequeue validators for activation up to churn limit, in order of activation_eligibility_epoch and index.
+    # Only the queued validators with a finalized placement are eligible, those are always at the front.
+    registry = take_registry_index(state)
+    activation_epoch = compute_activation_exit_epoch(current_epoch)
+    queue = registry.activation_queue
+    for _ in range(get_validator_churn_limit(state)):
+        if len(queue) == 0 or queue[0][0] > state.finalized_checkpoint.epoch:
+            break
+        _, index = heappop(queue)
+        state.validators[index].activation_epoch = activation_epoch
+    keep_registry_index(state, registry)
+
+
+_process_registry_updates = process_registry_updates
+process_registry_updates = process_registry_updates_indexed
+
+
+# Sums of the slashings vector, keyed by its root. Updates of the vector carry the sum over to the new root.
+_slashings_totals = LRU(size=8)
+
+
+def get_slashings_total(state: BeaconState) -> Gwei:
+    key = state.slashings.hash_tree_root()
+    if key not in _slashings_totals:
+        _slashings_totals[key] = Gwei(sum(packed_array(state.slashings).tolist()))
+    return _slashings_totals[key]
+
+
+def set_slashings(state: BeaconState, index: uint64, value: Gwei) -> None:
+    """Set an entry of the slashings vector, and carry the total over to the new vector root."""
+    total = get_slashings_total(state) - state.slashings[index] + value
+    state.slashings[index] = value
+    _slashings_totals[state.slashings.hash_tree_root()] = Gwei(total)
+
+
+def slash_validator_scheduled(state: BeaconState,
+                              slashed_index: ValidatorIndex,
+                              whistleblower_index: ValidatorIndex=None) -> None:
+    """
+    Slash the validator with index ``slashed_index``, and schedule its slashing penalty in the registry index.
+    """
+    epoch = get_current_epoch(state)
+    initiate_validator_exit(state, slashed_index)
+    registry = take_registry_index(state)
+    validator = state.validators[slashed_index]
+    validator.slashed = True
+    validator.withdrawable_epoch = max(validator.withdrawable_epoch, Epoch(epoch + EPOCHS_PER_SLASHINGS_VECTOR))
+    registry.add_slashed(slashed_index, validator.withdrawable_epoch)
+    keep_registry_index(state, registry)
+    slashings_index = epoch % EPOCHS_PER_SLASHINGS_VECTOR
+    set_slashings(state, slashings_index, state.slashings[slashings_index] + validator.effective_balance)
+    decrease_balance(state, slashed_index, validator.effective_balance // MIN_SLASHING_PENALTY_QUOTIENT)
+
+    # Apply proposer and whistleblower rewards
+    proposer_index = get_beacon_proposer_index(state)
+    if whistleblower_index is None:
+        whistleblower_index = proposer_index
+    whistleblower_reward = Gwei(validator.effective_balance // WHISTLEBLOWER_REWARD_QUOTIENT)
+    proposer_reward = Gwei(whistleblower_reward // PROPOSER_REWARD_QUOTIENT)
+    increase_balance(state, proposer_index, proposer_reward)
+    increase_balance(state, whistleblower_index, whistleblower_reward - proposer_reward)
+
+
+_slash_validator = slash_validator
+slash_validator = slash_validator_scheduled
+
+
+def process_slashings_scheduled(state: BeaconState) -> None:
+    epoch = get_current_epoch(state)
+    # Only the validators that were scheduled for this epoch, no registry scan
+    due_epoch = Epoch(epoch + EPOCHS_PER_SLASHINGS_VECTOR // 2)
+    registry = get_registry_index(state)
+    if due_epoch <= registry.slashing_schedule_pruned:
+        # Already processed for another state with the same registry (e.g. one advanced ahead of time),
+        # and dropped from the schedule: scan the registry like the spec does.
+        _process_slashings(state)
+        return
+    if due_epoch not in registry.slashing_schedule:
+        return
+    # Handled now, drop the entry: the schedule only holds penalties that are still due
+    registry = take_registry_index(state)
+    slashed_indices = registry.slashing_schedule.pop(due_epoch)
+    registry.slashing_schedule_pruned = due_epoch
+    keep_registry_index(state, registry)
+    total_balance = get_total_active_balance(state)
+    # Slashing penalties do not change the slashings vector, its sum is the same for all of them
+    slashings_total = get_slashings_total(state)
+    for index in sorted(slashed_indices):
+        validator = state.validators[index]
+        increment = EFFECTIVE_BALANCE_INCREMENT  # Factored out from penalty numerator to avoid uint64 overflow
+        penalty_numerator = validator.effective_balance // increment * min(slashings_total * 3, total_balance)
+        penalty = penalty_numerator // total_balance * increment
+        decrease_balance(state, ValidatorIndex(index), penalty)
+
+
+_process_slashings = process_slashings
+process_slashings = process_slashings_scheduled
+
+
+# Validator records for the hot read loops, re-read only for the validators that were written (see state_accessor.py).
+# One per thread, blocks may be produced or advanced in other threads.
+_validator_records = local()
+
+
+def get_validator_records(state: BeaconState) -> ValidatorRecords:
+    if not hasattr(_validator_records, 'records'):
+        _validator_records.records = ValidatorRecords()
+    return _validator_records.records.sync(state.validators)
+
+
+def clear_state_caches() -> None:
+    """
+    Forget the cached values that hold views or nodes of the states they were computed on: the validator records
+    of this thread (and the registry backing they follow), the eth1 votes, and the matching attestations.
+    Call it before those nodes become unreadable, e.g. when they are part of a shared memory tree that is
+    closed next (see ``workers.py``). The other caches only hold plain values, keyed by roots.
+    """
+    if hasattr(_validator_records, 'records'):
+        del _validator_records.records
+    _eth1_vote_trackers.clear()
+    get_matching_target_attestations.cache_clear()
+    get_matching_head_attestations.cache_clear()
+
+
+def get_validator_record(state: BeaconState, index: ValidatorIndex) -> ValidatorRecord:
+    return get_validator_records(state)[index]
+
+
+def get_active_validator_indices_accessed(state: BeaconState, epoch: Epoch) -> Sequence[ValidatorIndex]:
+    return [ValidatorIndex(i) for i, v in enumerate(get_validator_records(state)) if is_active_validator(v, epoch)]
+
+
+get_active_validator_indices = cache_this(
+    lambda state, epoch: (state.validators.hash_tree_root(), epoch),
+    get_active_validator_indices_accessed, lru_size=3)
+
+
+def get_total_balance_accessed(state: BeaconState, indices: Set[ValidatorIndex]) -> Gwei:
+    records = get_validator_records(state)
+    return Gwei(max(1, sum([records[index].effective_balance for index in indices])))
+
+
+_get_total_balance = get_total_balance
+get_total_balance = get_total_balance_accessed
+
+
+def get_base_reward_accessed(state: BeaconState, index: ValidatorIndex) -> Gwei:
+    total_balance = get_total_active_balance(state)
+    effective_balance = get_validator_record(state, index).effective_balance
+    return Gwei(effective_balance * BASE_REWARD_FACTOR // integer_squareroot(total_balance) // BASE_REWARDS_PER_EPOCH)
+
+
+# Replaces the LRU: a record lookup is cheaper than its key (the registry root)
+get_base_reward = get_base_reward_accessed
+
+
+def get_unslashed_attesting_indices_accessed(state: BeaconState,
+                                             attestations: Sequence[PendingAttestation]) -> Set[ValidatorIndex]:
+    output = set()  # type: Set[ValidatorIndex]
+    for a in attestations:
+        output.update(get_attesting_indices(state, a.data, a.aggregation_bits).tolist())
+    records = get_validator_records(state)
+    return set(filter(lambda index: not records[index].slashed, output))
+
+
+_get_unslashed_attesting_indices = get_unslashed_attesting_indices
+get_unslashed_attesting_indices = get_unslashed_attesting_indices_accessed
+
+
+def get_attestation_deltas_accessed(state: BeaconState) -> Tuple[Sequence[Gwei], Sequence[Gwei]]:
+    previous_epoch = get_previous_epoch(state)
+    total_balance = get_total_active_balance(state)
+    records = get_validator_records(state)
+    rewards = [Gwei(0) for _ in range(len(records))]
+    penalties = [Gwei(0) for _ in range(len(records))]
+    eligible_validator_indices = [
+        ValidatorIndex(index) for index, v in enumerate(records)
+        if is_active_validator(v, previous_epoch) or (v.slashed and previous_epoch + 1 < v.withdrawable_epoch)
+    ]
+
+    # Micro-incentives for matching FFG source, FFG target, and head
+    matching_source_attestations = get_matching_source_attestations(state, previous_epoch)
+    matching_target_attestations = get_matching_target_attestations(state, previous_epoch)
+    matching_head_attestations = get_matching_head_attestations(state, previous_epoch)
+    for attestations in (matching_source_attestations, matching_target_attestations, matching_head_attestations):
+        unslashed_attesting_indices = get_unslashed_attesting_indices(state, attestations)
+        attesting_balance = get_total_balance(state, unslashed_attesting_indices)
+        for index in eligible_validator_indices:
+            if index in unslashed_attesting_indices:
+                rewards[index] += get_base_reward(state, index) * attesting_balance // total_balance
+            else:
+                penalties[index] += get_base_reward(state, index)
+
+    # Proposer and inclusion delay micro-rewards
+    # The first attestation with the minimum inclusion delay per attester, in a single pass over the attestations
+    earliest = {}  # type: Dict[ValidatorIndex, PendingAttestation]
+    for a in matching_source_attestations:
+        for index in get_attesting_indices(state, a.data, a.aggregation_bits).tolist():
+            if index not in earliest or a.inclusion_delay < earliest[index].inclusion_delay:
+                earliest[index] = a
+    for index in get_unslashed_attesting_indices(state, matching_source_attestations):
+        attestation = earliest[index]
+        proposer_reward = Gwei(get_base_reward(state, index) // PROPOSER_REWARD_QUOTIENT)
+        rewards[attestation.proposer_index] += proposer_reward
+        max_attester_reward = get_base_reward(state, index) - proposer_reward
+        rewards[index] += Gwei(max_attester_reward // attestation.inclusion_delay)
+
+    # Inactivity penalty
+    finality_delay = previous_epoch - state.finalized_checkpoint.epoch
+    if finality_delay > MIN_EPOCHS_TO_INACTIVITY_PENALTY:
+        matching_target_attesting_indices = get_unslashed_attesting_indices(state, matching_target_attestations)
+        for index in eligible_validator_indices:
+            penalties[index] += Gwei(BASE_REWARDS_PER_EPOCH * get_base_reward(state, index))
+            if index not in matching_target_attesting_indices:
+                effective_balance = records[index].effective_balance
+                penalties[index] += Gwei(effective_balance * finality_delay // INACTIVITY_PENALTY_QUOTIENT)
+
+    return rewards, penalties
+
+
+_get_attestation_deltas = get_attestation_deltas
+get_attestation_deltas = get_attestation_deltas_accessed
+
+
+# Attesting indices keyed by the bits root and the inputs of the committee, like get_beacon_committee:
+# the repeated reads of the pending attestations in an epoch transition are lookups. Bitlist roots are cached
+# in their nodes, pending attestations keep them across blocks. Entries reference no nodes of the state.
+_attesting_indices = LRU(size=SLOTS_PER_EPOCH * MAX_COMMITTEES_PER_SLOT * 3)
+
+
+def get_attesting_indices_array(state: BeaconState,
+                                data: AttestationData,
+                                bits: Bitlist[MAX_VALIDATORS_PER_COMMITTEE]) -> np.ndarray:
+    """
+    Return the attesting indices corresponding to ``data`` and ``bits``, in committee order, as a read-only array.
+    """
+    key = (bits.hash_tree_root(), state.validators.hash_tree_root(),
+           get_seed(state, compute_epoch_at_slot(data.slot), DOMAIN_BEACON_ATTESTER), data.slot, data.index)
+    if key in _attesting_indices:
+        return _attesting_indices[key]
+    committee = get_beacon_committee(state, data.slot, data.index)
+    indices = np.asarray(committee, dtype=np.uint64)[bitlist_array(bits)[:len(committee)]]
+    indices.flags.writeable = False
+    _attesting_indices[key] = indices
+    return indices
+
+
+get_attesting_indices = get_attesting_indices_array
+
+
+def get_indexed_attestation_array(state: BeaconState, attestation: Attestation) -> IndexedAttestation:
+    attesting_indices = get_attesting_indices(state, attestation.data, attestation.aggregation_bits)
+
+    return IndexedAttestation(
+        attesting_indices=np.sort(attesting_indices).tolist(),
+        data=attestation.data,
+        signature=attestation.signature,
+    )
+
+
+_get_indexed_attestation = get_indexed_attestation
+get_indexed_attestation = get_indexed_attestation_array
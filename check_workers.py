@@ -0,0 +1,97 @@
+"""
+Run consecutive epoch transitions in a ``StateWorkers`` process, and compare them with the same transitions in this process.
+
+A worker keeps its spec module, and the caches in it, from one job to the next, while the shared memory tree of a job
+is closed when the job is done. Every job after the first catches caches that still read nodes of an earlier job.
+Every transition runs twice from the same pre-state, the second time hits the caches keyed by the roots of the first.
+
+Usage: python check_workers.py [--state lighthouse/genesis.ssz] [--spec fast|canon|both] [--jobs N]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from typing import Optional, Sequence
+
+from eth2spec.config.config_util import prepare_config
+
+from importlib import reload
+
+import fast_spec
+import canon_spec
+
+from workers import StateWorkers
+
+# Apply lighthouse config to spec
+prepare_config("./lighthouse", "config")
+reload(fast_spec)
+reload(canon_spec)
+
+# Turn off sig verification
+fast_spec.bls.bls_active = False
+canon_spec.bls.bls_active = False
+
+
+def load_state(filepath: str) -> fast_spec.BeaconState:
+    state_size = os.stat(filepath).st_size
+    with io.open(filepath, 'br') as f:
+        return fast_spec.BeaconState.deserialize(f, state_size)
+
+
+def local_process_slots(spec_name: str, state, slot: int):
+    """A new state: ``state`` (not modified) advanced to ``slot`` in this process."""
+    if spec_name == 'fast':
+        state = state.copy()
+        epochs_ctx = fast_spec.EpochsContext()
+        epochs_ctx.load_state(state)
+        fast_spec.process_slots(epochs_ctx, state, slot)
+        return state
+    state = canon_spec.BeaconState.view_from_backing(state.get_backing())
+    canon_spec.process_slots(state, slot)
+    return state
+
+
+def check(spec_name: str, pre_state, jobs: int) -> bool:
+    # Past the first epochs, which skip justification and rewards
+    start_slot = max(int(pre_state.slot), 3 * fast_spec.SLOTS_PER_EPOCH) + 1
+    state = local_process_slots(spec_name, pre_state, start_slot)
+    ok = True
+    with StateWorkers(f'{spec_name}_spec', './lighthouse', 'config', bls_active=False) as workers:
+        for job in range(jobs):
+            slot = (state.slot // fast_spec.SLOTS_PER_EPOCH + 1) * fast_spec.SLOTS_PER_EPOCH + 1
+            expected = local_process_slots(spec_name, state, slot)
+            for run in range(2):
+                start = time.perf_counter()
+                try:
+                    post = workers.process_slots_sync(state, slot)
+                except Exception as e:
+                    print(f"[{spec_name}] job {job}.{run}, slot {state.slot} -> {slot}: worker failed: {e!r}")
+                    return False
+                elapsed = time.perf_counter() - start
+                matches = post.hash_tree_root() == expected.hash_tree_root()
+                print(f"[{spec_name}] job {job}.{run}, slot {state.slot} -> {slot}: {elapsed * 1000.0:.1f} ms, "
+                      f"{'matches' if matches else 'DIFFERS from'} the local transition")
+                ok = ok and matches
+            # The next job starts from the worker result, a tree the worker has not seen before.
+            state = post
+    return ok
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Check epoch transitions in worker processes, over several jobs.")
+    parser.add_argument('--state', default='lighthouse/genesis.ssz', help="pre-state, advanced to epoch 3 first")
+    parser.add_argument('--spec', choices=('fast', 'canon', 'both'), default='both')
+    parser.add_argument('--jobs', type=int, default=2, help="number of consecutive jobs, per spec")
+    args = parser.parse_args(args)
+
+    pre_state = load_state(args.state)
+    ok = True
+    for spec_name in (('fast', 'canon') if args.spec == 'both' else (args.spec,)):
+        ok = check(spec_name, pre_state, args.jobs) and ok
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
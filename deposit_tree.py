@@ -0,0 +1,65 @@
+from hashlib import sha256
+from typing import List
+
+
+def _hash(data: bytes) -> bytes:
+    return sha256(data).digest()
+
+
+class DepositTree(object):
+    """
+    Append-only deposit Merkle tree, like the deposit contract keeps it: only the frontier is stored,
+    the last left-complete subtree root at every height. Appending a leaf and computing the root
+    both cost ``depth`` hashes at most, and memory is ``O(depth)``, regardless of the deposit count.
+    The tree holds ``2**depth`` leaves, the root of a full tree is kept at ``branch[depth]``.
+    """
+    depth: int
+    count: int
+    branch: List[bytes]
+    zero_hashes: List[bytes]
+
+    def __init__(self, depth: int = 32):
+        self.depth = depth
+        self.count = 0
+        self.branch = [bytes(32)] * (depth + 1)
+        self.zero_hashes = [bytes(32)]
+        for _ in range(depth):
+            self.zero_hashes.append(_hash(self.zero_hashes[-1] + self.zero_hashes[-1]))
+
+    def append(self, leaf: bytes) -> None:
+        assert self.count < 2**self.depth
+        self.count += 1
+        node = leaf
+        size = self.count
+        for height in range(self.depth + 1):
+            if size % 2 == 1:
+                self.branch[height] = node
+                return
+            node = _hash(self.branch[height] + node)
+            size //= 2
+
+    def root(self) -> bytes:
+        """The root of the deposits list: the tree root with the deposit count mixed in."""
+        if self.count == 2**self.depth:
+            return _hash(self.branch[self.depth] + self.count.to_bytes(32, 'little'))
+        node = bytes(32)
+        size = self.count
+        for height in range(self.depth):
+            if size % 2 == 1:
+                node = _hash(self.branch[height] + node)
+            else:
+                node = _hash(node + self.zero_hashes[height])
+            size //= 2
+        return _hash(node + self.count.to_bytes(32, 'little'))
+
+    def last_proof(self) -> List[bytes]:
+        """
+        The Merkle branch of the last appended leaf against the current ``root()``, length mix-in included.
+        The left siblings of that leaf are exactly the frontier, the right siblings are all empty subtrees.
+        """
+        assert self.count > 0
+        index = self.count - 1
+        proof = [self.branch[height] if (index >> height) % 2 == 1 else self.zero_hashes[height]
+                 for height in range(self.depth)]
+        proof.append(self.count.to_bytes(32, 'little'))
+        return proof
@@ -0,0 +1,194 @@
+"""
+Differential replay: run blocks through both fast_spec and canon_spec, step by step, and stop at the first divergence.
+
+State roots are compared after the slots up to every block, run with the real ``process_slots`` of both specs
+(canon skips runs of empty slots), and after every block. On a slot mismatch, the same slots are stepped through
+again from the pre-states, with a check after every slot and every epoch sub-step, to find the first diverging step.
+The tree diff reports the field and gindex that diverged, and the pre-state and block of the failing transition
+are written to ``fail_state_pre.ssz`` and ``fail_block.ssz``, ready for ``diff_transition.py``.
+
+Usage: python diff_replay.py [fixtures_dir] [--limit N]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+from typing import Optional, Sequence
+
+from eth2spec.config.config_util import prepare_config
+
+from importlib import reload
+
+import fast_spec
+import canon_spec
+
+from remerkleable.tree import Node
+
+from sync import list_block_files
+from tree_diff import describe_diff
+
+# Apply lighthouse config to spec
+prepare_config("./lighthouse", "config")
+reload(fast_spec)
+reload(canon_spec)
+
+# Turn off sig verification
+fast_spec.bls.bls_active = False
+canon_spec.bls.bls_active = False
+
+EPOCH_STEPS = (
+    'process_justification_and_finalization',
+    'process_rewards_and_penalties',
+    'process_registry_updates',
+    'process_slashings',
+    'process_final_updates',
+)
+
+
+class Divergence(Exception):
+    pass
+
+
+def load_state(filepath: str) -> fast_spec.BeaconState:
+    state_size = os.stat(filepath).st_size
+    with io.open(filepath, 'br') as f:
+        return fast_spec.BeaconState.deserialize(f, state_size)
+
+
+def load_block(filepath: str) -> fast_spec.SignedBeaconBlock:
+    block_size = os.stat(filepath).st_size
+    with io.open(filepath, 'br') as f:
+        return fast_spec.SignedBeaconBlock.deserialize(f, block_size)
+
+
+class DiffReplay(object):
+    fast_state: fast_spec.BeaconState
+    canon_state: canon_spec.BeaconState
+    epochs_ctx: fast_spec.EpochsContext
+    block_pre_backing: Node
+    checks: int
+
+    def __init__(self, state: fast_spec.BeaconState):
+        self.fast_state = fast_spec.BeaconState.view_from_backing(state.get_backing())
+        self.canon_state = canon_spec.BeaconState.view_from_backing(state.get_backing())
+        self.epochs_ctx = fast_spec.EpochsContext()
+        self.epochs_ctx.load_state(self.fast_state)
+        self.block_pre_backing = state.get_backing()
+        self.checks = 0
+
+    def check(self, step: str, signed_block: Optional[fast_spec.SignedBeaconBlock] = None):
+        self.checks += 1
+        fast_backing = self.fast_state.get_backing()
+        canon_backing = self.canon_state.get_backing()
+        diff = describe_diff(fast_spec.BeaconState, fast_backing, canon_backing)
+        if diff is None:
+            return
+        self.fail(f"{step} at slot {self.canon_state.slot}: fast != canon at {diff}", signed_block)
+
+    def fail(self, msg: str, signed_block: Optional[fast_spec.SignedBeaconBlock] = None):
+        with io.open('fail_state_pre.ssz', 'bw') as f:
+            fast_spec.BeaconState.view_from_backing(self.block_pre_backing).serialize(f)
+        if signed_block is not None:
+            with io.open('fail_block.ssz', 'bw') as f:
+                signed_block.serialize(f)
+        raise Divergence(msg)
+
+    def step(self, step: str, fast_fn, canon_fn, signed_block=None):
+        """Run a step on both states, then compare."""
+        fast_fn()
+        canon_fn()
+        self.check(step, signed_block)
+
+    def process_slots(self, slot: int, signed_block: Optional[fast_spec.SignedBeaconBlock] = None):
+        """
+        Run the real process_slots of both specs up to ``slot``, and compare. On a mismatch, step through the same
+        slots from the pre-states (see ``step_slots``) to find the first diverging step. If the stepping agrees,
+        the process_slots of one of the specs diverges from its own slot by slot processing, e.g. the canon skip path.
+        """
+        if self.canon_state.slot >= slot:
+            return
+        fast_pre, canon_pre = self.fast_state.get_backing(), self.canon_state.get_backing()
+        epochs_ctx_pre = self.epochs_ctx.copy()
+        fast_spec.process_slots(self.epochs_ctx, self.fast_state, slot)
+        canon_spec.process_slots(self.canon_state, slot)
+        self.checks += 1
+        fast_post, canon_post = self.fast_state.get_backing(), self.canon_state.get_backing()
+        diff = describe_diff(fast_spec.BeaconState, fast_post, canon_post)
+        if diff is None:
+            return
+
+        self.fast_state.set_backing(fast_pre)
+        self.canon_state.set_backing(canon_pre)
+        self.epochs_ctx = epochs_ctx_pre
+        self.step_slots(slot, signed_block)
+        canon_diff = describe_diff(canon_spec.BeaconState, canon_post, self.canon_state.get_backing())
+        if canon_diff is not None:
+            self.fail(f"process_slots to slot {slot}: canon process_slots != canon slot by slot at {canon_diff}",
+                      signed_block)
+        fast_diff = describe_diff(fast_spec.BeaconState, fast_post, self.fast_state.get_backing())
+        if fast_diff is not None:
+            self.fail(f"process_slots to slot {slot}: fast process_slots != fast slot by slot at {fast_diff}",
+                      signed_block)
+        self.fail(f"process_slots to slot {slot}: fast != canon at {diff}, but not when stepping slot by slot",
+                  signed_block)
+
+    def step_slots(self, slot: int, signed_block: Optional[fast_spec.SignedBeaconBlock] = None):
+        """Same stepping as process_slots in both specs, with a check after every step."""
+        fast, canon = self.fast_state, self.canon_state
+        epochs_ctx = self.epochs_ctx
+        while canon.slot < slot:
+            self.step('process_slot',
+                      lambda: fast_spec.process_slot(epochs_ctx, fast),
+                      lambda: canon_spec.process_slot(canon), signed_block)
+            if (canon.slot + 1) % canon_spec.SLOTS_PER_EPOCH == 0:
+                process = fast_spec.prepare_epoch_process_state(epochs_ctx, fast)
+                for name in EPOCH_STEPS:
+                    self.step(name,
+                              lambda: getattr(fast_spec, name)(epochs_ctx, process, fast),
+                              lambda: getattr(canon_spec, name)(canon), signed_block)
+                fast.slot += 1
+                canon.slot += 1
+                epochs_ctx.rotate_epochs(fast)
+            else:
+                fast.slot += 1
+                canon.slot += 1
+
+    def process_block(self, signed_block: fast_spec.SignedBeaconBlock):
+        self.block_pre_backing = self.canon_state.get_backing()
+        self.process_slots(signed_block.message.slot, signed_block)
+        fast_block = fast_spec.BeaconBlock.view_from_backing(signed_block.message.get_backing())
+        canon_block = canon_spec.BeaconBlock.view_from_backing(signed_block.message.get_backing())
+        self.step('process_block',
+                  lambda: fast_spec.process_block(self.epochs_ctx, self.fast_state, fast_block),
+                  lambda: canon_spec.process_block(self.canon_state, canon_block), signed_block)
+        if signed_block.message.state_root != self.canon_state.hash_tree_root():
+            print(f"warning: both specs agree, but the post-state root at slot {signed_block.message.slot}"
+                  f" does not match the block state root")
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay blocks through fast_spec and canon_spec, "
+                                                 "stop at the first divergence.")
+    parser.add_argument('fixtures', nargs='?', default='fixtures',
+                        help="directory with state.ssz and block_<slot>.ssz files")
+    parser.add_argument('--limit', type=int, default=None, help="replay at most this many blocks")
+    args = parser.parse_args(args)
+
+    block_files = list_block_files(args.fixtures)
+    slots = sorted(block_files.keys())[:args.limit]
+
+    replay = DiffReplay(load_state(os.path.join(args.fixtures, 'state.ssz')))
+    start = time.perf_counter()
+    try:
+        for slot in slots:
+            replay.process_block(load_block(block_files[slot]))
+    except Divergence as e:
+        print(e)
+        print("inputs of the diverging transition written to fail_state_pre.ssz and fail_block.ssz")
+        sys.exit(1)
+    print(f"no divergence in {len(slots)} blocks, {replay.checks} checks, {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+from typing import Callable, Generic, Optional, TypeVar
+
+from lru import LRU
+
+from remerkleable.core import View
+
+T = TypeVar('T')
+
+
+def head_block_root(state: View) -> bytes:
+    """The root of the latest block of ``state``, also before process_slot filled in its state root."""
+    header = state.latest_block_header.copy()
+    if header.state_root == bytes(32):
+        header.state_root = state.hash_tree_root()
+    return header.hash_tree_root()
+
+
+class SlotLookahead(Generic[T]):
+    """
+    Head states advanced to a later slot ahead of time, keyed by (head block root, slot).
+
+    ``prepare`` runs ``advance`` (``process_slots`` on a copy, including the epoch transition if there is one)
+    in idle time. When the block of that slot arrives, ``get`` returns a copy of the advanced state,
+    and the import skips the slot processing. The cached state is never modified, it stays valid for other blocks
+    of the same slot and parent. ``T`` is whatever the spec needs to transition, e.g. a state and an epochs context.
+    """
+    advance: Callable[[T, int], T]
+    copy: Callable[[T], T]
+    hits: int
+    misses: int
+
+    def __init__(self, advance: Callable[[T, int], T], copy: Callable[[T], T], size: int = 4):
+        self.advance = advance
+        self.copy = copy
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRU(size=size)
+
+    def prepare(self, head_root: bytes, head: T, slot: int) -> None:
+        """Advance ``head`` (not modified) to ``slot``, unless it was already prepared."""
+        key = (bytes(head_root), int(slot))
+        if key not in self._cache:
+            self._cache[key] = self.advance(head, slot)
+
+    def get(self, head_root: bytes, slot: int) -> Optional[T]:
+        """A copy of the prepared state of ``head_root`` at ``slot``, None if it was not prepared."""
+        key = (bytes(head_root), int(slot))
+        if key not in self._cache:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.copy(self._cache[key])
@@ -0,0 +1,95 @@
+"""
+Generate a genesis state with N validators, e.g. to test with a much larger registry than ``lighthouse/genesis.ssz``.
+
+Deposits are built with an incremental ``DepositTree`` (the proof of every deposit is taken from the tree
+right after appending it), and the state with the bulk ``initialize_beacon_state_from_eth1`` of ``canon_spec``.
+Keys are the interop keys (private key ``i`` is the sha256 of ``i``) when ``--sign`` is set,
+otherwise pubkeys are fake and BLS is turned off, which is much faster.
+
+Usage: python make_genesis.py N [--sign] [--eth1-timestamp T] [--out genesis.ssz]
+"""
+import argparse
+import io
+import time
+from hashlib import sha256
+from typing import List, Optional, Sequence
+
+from eth2spec.config.config_util import prepare_config
+
+from importlib import reload
+
+import canon_spec
+
+from deposit_tree import DepositTree
+
+# Apply lighthouse config to spec
+prepare_config("./lighthouse", "config")
+reload(canon_spec)
+
+CURVE_ORDER = 52435875175126190479600763856928042108571924296694066768166436066136637302785
+
+
+def interop_privkey(index: int) -> int:
+    return int.from_bytes(sha256(index.to_bytes(32, 'little')).digest(), 'little') % CURVE_ORDER
+
+
+def make_deposits(count: int, sign: bool) -> List[canon_spec.Deposit]:
+    spec = canon_spec
+    tree = DepositTree(spec.DEPOSIT_CONTRACT_TREE_DEPTH)
+    domain = spec.compute_domain(spec.DOMAIN_DEPOSIT)
+    deposits = []
+    for i in range(count):
+        if sign:
+            privkey = interop_privkey(i)
+            pubkey = spec.BLSPubkey(spec.bls.SkToPk(privkey))
+        else:
+            pubkey = spec.BLSPubkey(i.to_bytes(48, 'little'))
+        withdrawal_credentials = spec.BLS_WITHDRAWAL_PREFIX + sha256(pubkey).digest()[1:]
+        data = spec.DepositData(
+            pubkey=pubkey,
+            withdrawal_credentials=withdrawal_credentials,
+            amount=spec.MAX_EFFECTIVE_BALANCE,
+        )
+        if sign:
+            deposit_message = spec.DepositMessage(
+                pubkey=pubkey,
+                withdrawal_credentials=withdrawal_credentials,
+                amount=data.amount,
+            )
+            data.signature = spec.bls.Sign(privkey, spec.compute_signing_root(deposit_message, domain))
+        tree.append(spec.hash_tree_root(data))
+        deposits.append(spec.Deposit(proof=tree.last_proof(), data=data))
+    return deposits
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Generate a genesis state with N validators.")
+    parser.add_argument('count', type=int, help="number of validators")
+    parser.add_argument('--sign', action='store_true',
+                        help="use interop keys and sign the deposits (slow), instead of fake pubkeys without BLS")
+    parser.add_argument('--eth1-block-hash', default='42' * 32, help="hex of the eth1 block hash")
+    parser.add_argument('--eth1-timestamp', type=int, default=None,
+                        help="eth1 timestamp, defaults to MIN_GENESIS_TIME")
+    parser.add_argument('--out', default='genesis.ssz', help="output SSZ file")
+    args = parser.parse_args(args)
+
+    canon_spec.bls.bls_active = args.sign
+
+    start = time.perf_counter()
+    deposits = make_deposits(args.count, args.sign)
+    print(f"built {len(deposits)} deposits in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    eth1_timestamp = canon_spec.MIN_GENESIS_TIME if args.eth1_timestamp is None else args.eth1_timestamp
+    state = canon_spec.initialize_beacon_state_from_eth1(
+        canon_spec.Bytes32(bytes.fromhex(args.eth1_block_hash)), eth1_timestamp, deposits)
+    print(f"built genesis state in {time.perf_counter() - start:.1f} s, "
+          f"valid genesis: {canon_spec.is_valid_genesis_state(state)}")
+
+    with io.open(args.out, 'bw') as f:
+        state.serialize(f)
+    print(f"written to {args.out}, state root: {state.hash_tree_root().hex()}")
+
+
+if __name__ == '__main__':
+    main()
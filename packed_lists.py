@@ -0,0 +1,106 @@
+from typing import List as PyList, Type, TypeVar, Union
+
+import numpy as np
+
+from remerkleable.bitfields import Bitlist
+from remerkleable.complex import List, Vector
+from remerkleable.tree import Node, PairNode, RootNode, zero_node
+
+V = TypeVar('V', List, Vector)
+
+
+def _element_byte_length(typ: Type[V]) -> int:
+    elem_typ = typ.element_cls()
+    assert typ.is_packed(), f"{typ.type_repr()} is not a packed list or vector"
+    return elem_typ.type_byte_length()
+
+
+def _as_bytes(typ: Type[V], data: Union[bytes, np.ndarray]) -> bytes:
+    if isinstance(data, np.ndarray):
+        return np.ascontiguousarray(data, dtype=f'<u{_element_byte_length(typ)}').tobytes()
+    return bytes(data)
+
+
+def merkleize_chunks(chunks: PyList[Node], depth: int) -> Node:
+    """Build a tree of ``depth`` over ``chunks`` bottom-up, one level at a time, padded with zero subtrees."""
+    assert len(chunks) <= 2**depth
+    if len(chunks) == 0:
+        return zero_node(depth)
+    nodes = chunks
+    for level in range(depth):
+        if len(nodes) % 2 == 1:
+            nodes = nodes + [zero_node(level)]
+        nodes = [PairNode(nodes[i], nodes[i + 1]) for i in range(0, len(nodes), 2)]
+    return nodes[0]
+
+
+def packed_backing(typ: Type[V], data: Union[bytes, np.ndarray]) -> Node:
+    """
+    Build the backing of the packed list or vector type ``typ`` (e.g. ``List[Gwei, ...]``) directly from the
+    little-endian serialized elements, or a NumPy array of them: 32-byte leaf chunks (4 uint64 each),
+    and then the tree bottom-up. No element views are created.
+    """
+    data = _as_bytes(typ, data)
+    elem_size = _element_byte_length(typ)
+    assert len(data) % elem_size == 0
+    length = len(data) // elem_size
+    if len(data) % 32 != 0:
+        data += b"\x00" * (32 - len(data) % 32)
+    chunks = [RootNode(data[i:i + 32]) for i in range(0, len(data), 32)]
+    if issubclass(typ, List):
+        assert length <= typ.limit()
+        return PairNode(merkleize_chunks(chunks, typ.contents_depth()), RootNode(length.to_bytes(32, 'little')))
+    else:
+        assert length == typ.vector_length()
+        return merkleize_chunks(chunks, typ.tree_depth())
+
+
+def packed_view(typ: Type[V], data: Union[bytes, np.ndarray]) -> V:
+    return typ.view_from_backing(packed_backing(typ, data))
+
+
+def _chunks_bytes(node: Node, depth: int, chunk_count: int) -> bytes:
+    """The first ``chunk_count`` leaf chunks of the subtree ``node`` of ``depth``, joined."""
+    if chunk_count == 0:
+        return b""
+    nodes = [node]
+    for level in range(depth):
+        # Subtrees below this level each cover 2**(depth - level - 1) chunks, skip the ones after the last chunk
+        span = 1 << (depth - level - 1)
+        needed = (chunk_count + span - 1) // span
+        next_nodes = []
+        for n in nodes:
+            next_nodes.append(n.get_left())
+            next_nodes.append(n.get_right())
+        nodes = next_nodes[:needed]
+    return b"".join(n.root for n in nodes)
+
+
+def packed_bytes(view: Union[List, Vector]) -> bytes:
+    """
+    The serialized elements of a packed list or vector: the leaf chunks joined, without reading element views.
+    Only the subtrees that contain elements are visited.
+    """
+    typ = view.__class__
+    elem_size = _element_byte_length(typ)
+    length = view.length()
+    backing = view.get_backing()
+    if issubclass(typ, List):
+        node, depth = backing.get_left(), typ.contents_depth()
+    else:
+        node, depth = backing, typ.tree_depth()
+    chunk_count = (length * elem_size + 31) // 32
+    return _chunks_bytes(node, depth, chunk_count)[:length * elem_size]
+
+
+def packed_array(view: Union[List, Vector]) -> np.ndarray:
+    """The elements of a packed list or vector of unsigned integers, as a NumPy array (a copy, writable)."""
+    elem_size = _element_byte_length(view.__class__)
+    return np.frombuffer(packed_bytes(view), dtype=f'<u{elem_size}').astype(f'u{elem_size}')
+
+
+def bitlist_array(view: Bitlist) -> np.ndarray:
+    """The bits of a bitlist as a NumPy bool array, unpacked from the leaf chunks of its backing."""
+    length = view.length()
+    data = _chunks_bytes(view.get_backing().get_left(), view.__class__.contents_depth(), (length + 255) // 256)
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=length, bitorder='little').view(bool)
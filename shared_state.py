@@ -0,0 +1,153 @@
+"""
+Hand a state tree to other processes through shared memory, without SSZ encoding and decoding.
+
+The tree is exported as a flat node table: the 32-byte roots of all nodes, and the (left, right) child indices of
+every pair node (-1 for leaves). Subtrees that are shared within the tree (e.g. zero subtrees) are stored once.
+Another process attaches to the segment by name, and navigates it lazily: nodes are only created for the paths
+that are read, and roots are not rehashed.
+
+Attached trees are read-only, writes to a view on them create new nodes in the local process, on top of the
+shared ones (copy on write), the segment itself is never modified.
+"""
+from array import array
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Type, TypeVar
+
+from remerkleable.core import View
+from remerkleable.tree import Node, RebindableNode, RootNode
+
+V = TypeVar('V', bound=View)
+
+# Header: magic, node count, root node index
+MAGIC = int.from_bytes(b"eth2tree", 'little')
+HEADER_SIZE = 3 * 8
+NO_CHILD = -1
+
+
+class SharedPairNode(RebindableNode):
+    """A pair node in a shared node table. Children are created on first access, the root is read from the table."""
+
+    __slots__ = 'tree', 'index', '_root', '_left', '_right'
+
+    def __init__(self, tree: 'SharedTree', index: int):
+        self.tree = tree
+        self.index = index
+        self._root = tree.root_at(index)
+        self._left = None
+        self._right = None
+
+    def get_left(self) -> Node:
+        if self._left is None:
+            self._left = self.tree.node(self.tree.children[2 * self.index])
+        return self._left
+
+    def get_right(self) -> Node:
+        if self._right is None:
+            self._right = self.tree.node(self.tree.children[2 * self.index + 1])
+        return self._right
+
+    def is_leaf(self) -> bool:
+        return False
+
+    def merkle_root(self) -> bytes:
+        return self._root
+
+    def __repr__(self) -> str:
+        return f"Shared({self.index}, 0x{self._root.hex()})"
+
+
+class SharedTree(object):
+    """
+    A node table in a shared memory segment, see ``export_tree`` and ``attach_tree``.
+    The process that exported the tree owns the segment and has to ``unlink`` it, after the others attached to it.
+    Nodes of the tree stay valid only as long as the segment is open (``close``) in this process.
+    """
+    shm: SharedMemory
+    count: int
+    root_index: int
+    roots: memoryview
+    children: memoryview
+
+    def __init__(self, shm: SharedMemory):
+        self.shm = shm
+        header = shm.buf[:HEADER_SIZE].cast('q')
+        magic, self.count, self.root_index = header
+        header.release()
+        assert magic == MAGIC, "not a node table"
+        roots_end = HEADER_SIZE + self.count * 32
+        self.roots = shm.buf[HEADER_SIZE:roots_end]
+        self.children = shm.buf[roots_end:roots_end + self.count * 2 * 8].cast('q')
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def root_at(self, index: int) -> bytes:
+        return bytes(self.roots[index * 32:(index + 1) * 32])
+
+    def node(self, index: Optional[int] = None) -> Node:
+        """The node at ``index`` in the table, the root of the tree by default."""
+        if index is None:
+            index = self.root_index
+        if self.children[2 * index] == NO_CHILD:
+            return RootNode(self.root_at(index))
+        return SharedPairNode(self, index)
+
+    def view(self, typ: Type[V]) -> V:
+        """A view of type ``typ`` on the tree, e.g. ``spec.BeaconState``."""
+        return typ.view_from_backing(self.node())
+
+    def close(self) -> None:
+        self.roots.release()
+        self.children.release()
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
+
+    def __enter__(self) -> 'SharedTree':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def export_tree(root: Node, name: Optional[str] = None) -> SharedTree:
+    """
+    Write the tree of ``root`` into a new shared memory segment (``name``, or a random one),
+    and return it attached in this process. Roots that are not cached yet are hashed first.
+    """
+    root.merkle_root()
+    # Number the nodes in pre-order, each distinct node object once
+    index: Dict[int, int] = {}
+    nodes: List[Node] = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) in index:
+            continue
+        index[id(node)] = len(nodes)
+        nodes.append(node)
+        if not node.is_leaf():
+            stack.append(node.get_right())
+            stack.append(node.get_left())
+
+    children = array('q', [NO_CHILD]) * (2 * len(nodes))
+    for i, node in enumerate(nodes):
+        if not node.is_leaf():
+            children[2 * i] = index[id(node.get_left())]
+            children[2 * i + 1] = index[id(node.get_right())]
+    header = array('q', [MAGIC, len(nodes), 0])
+    roots = b"".join(node.root for node in nodes)
+
+    size = HEADER_SIZE + len(roots) + len(children) * 8
+    shm = SharedMemory(name=name, create=True, size=size)
+    shm.buf[:HEADER_SIZE] = header.tobytes()
+    shm.buf[HEADER_SIZE:HEADER_SIZE + len(roots)] = roots
+    shm.buf[HEADER_SIZE + len(roots):size] = children.tobytes()
+    return SharedTree(shm)
+
+
+def attach_tree(name: str) -> SharedTree:
+    """Attach to a node table exported by another process."""
+    return SharedTree(SharedMemory(name=name))
@@ -0,0 +1,110 @@
+"""
+Read-through access to the validator registry, for loops that read the same validator fields over and over.
+
+``state.validators[index].effective_balance`` creates two views and walks a ~45-deep gindex on every read.
+``ValidatorRecords`` decodes the fields of a validator once, straight from the leaf nodes of its subtree,
+and keeps the record in a dict. Records stay valid while the registry is not written: on every ``sync`` the
+registry backing is compared by node identity with the previous one, and only the validators whose subtree
+changed are dropped. No write hooks are needed, any write to the registry replaces the nodes on its path.
+"""
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from remerkleable.complex import List
+from remerkleable.tree import Node
+
+
+class ValidatorRecord(NamedTuple):
+    """The fields of a ``Validator`` that the transition reads in loops, named like the container fields."""
+    effective_balance: int
+    slashed: bool
+    activation_eligibility_epoch: int
+    activation_epoch: int
+    exit_epoch: int
+    withdrawable_epoch: int
+
+
+def _uint64(node: Node) -> int:
+    return int.from_bytes(node.root[:8], 'little')
+
+
+def decode_validator_record(node: Node) -> ValidatorRecord:
+    """
+    Decode a record from the backing of a ``Validator``: 8 fields, leaves at depth 3, the right half holds
+    the 4 epochs, the left half (pubkey, withdrawal credentials), (effective balance, slashed).
+    """
+    left, right = node.get_left(), node.get_right()
+    balance_slashed = left.get_right()
+    eligibility_activation, exit_withdrawable = right.get_left(), right.get_right()
+    return ValidatorRecord(
+        effective_balance=_uint64(balance_slashed.get_left()),
+        slashed=balance_slashed.get_right().root[0] != 0,
+        activation_eligibility_epoch=_uint64(eligibility_activation.get_left()),
+        activation_epoch=_uint64(eligibility_activation.get_right()),
+        exit_epoch=_uint64(exit_withdrawable.get_left()),
+        withdrawable_epoch=_uint64(exit_withdrawable.get_right()),
+    )
+
+
+class ValidatorRecords(object):
+    """
+    Records of a validator registry (``List[Validator, ...]``), by index. ``sync`` it with the registry of the state
+    before reading, it can follow any state: it only re-reads the validators that differ from the previous one.
+    Not thread-safe, use one per thread.
+    """
+    backing: Optional[Node]
+    depth: int
+    length: int
+    records: Dict[int, ValidatorRecord]
+
+    def __init__(self):
+        self.backing = None
+        self.depth = 0
+        self.length = 0
+        self.records = {}
+
+    def sync(self, validators: List) -> 'ValidatorRecords':
+        backing = validators.get_backing()
+        if backing is self.backing:
+            return self
+        depth = validators.__class__.contents_depth()
+        if self.backing is None or depth != self.depth:
+            self.records.clear()
+        else:
+            self._invalidate(self.backing.get_left(), backing.get_left(), depth, 0)
+        self.backing = backing
+        self.depth = depth
+        self.length = validators.length()
+        return self
+
+    def _invalidate(self, old: Node, new: Node, depth: int, index: int) -> None:
+        # Walk the subtrees that are not the same node objects, down to the validators that changed
+        if old is new:
+            return
+        if depth == 0:
+            self.records.pop(index, None)
+            return
+        if old.is_leaf() or new.is_leaf():
+            # A zero subtree on one side (validators appended or removed): drop the whole range
+            end = index + (1 << depth)
+            for i in [i for i in self.records if index <= i < end]:
+                del self.records[i]
+            return
+        half = 1 << (depth - 1)
+        self._invalidate(old.get_left(), new.get_left(), depth - 1, index)
+        self._invalidate(old.get_right(), new.get_right(), depth - 1, index + half)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> ValidatorRecord:
+        record = self.records.get(index)
+        if record is None:
+            if not 0 <= index < self.length:
+                raise IndexError(f"validator index {index} out of range {self.length}")
+            node = self.backing.get_left().getter((1 << self.depth) | index)
+            record = decode_validator_record(node)
+            self.records[index] = record
+        return record
+
+    def __iter__(self) -> Iterator[ValidatorRecord]:
+        return (self[i] for i in range(self.length))
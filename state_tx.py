@@ -0,0 +1,23 @@
+from contextlib import contextmanager
+from typing import Iterator
+
+from remerkleable.core import View
+from remerkleable.tree import Node
+
+
+@contextmanager
+def state_transaction(state: View) -> Iterator[Node]:
+    """
+    Mutate ``state`` in place, as a transaction. Yields the pre-state backing.
+
+    Remerkleable trees are immutable: every write rebinds a new root, and leaves the pre-state tree intact.
+    Committing is a no-op, the new root simply stays. On error the state is rolled back by
+    swapping the pre-state root back in, and the error is raised again.
+    """
+    pre = state.get_backing()
+    try:
+        yield pre
+    except BaseException:
+        state.set_backing(pre)
+        raise
+
@@ -0,0 +1,524 @@
+import io
+import os
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Protocol, Sequence, \
+    Set, Tuple
+
+import trio
+
+from remerkleable.complex import Container
+from remerkleable.byte_arrays import Bytes32, Bytes4
+from remerkleable.basic import uint64
+
+
+class Goodbye(uint64):
+    pass
+
+
+class Status(Container):
+    version: Bytes4
+    finalized_root: Bytes32
+    finalized_epoch: uint64
+    head_root: Bytes32
+    head_slot: uint64
+
+
+class BlocksByRange(Container):
+    head_block_root: Bytes32
+    start_slot: uint64
+    count: uint64
+    step: uint64
+
+
+class RangeRequestError(Exception):
+    pass
+
+
+class BlockSource(Protocol):
+    def blocks_by_range(self, start_slot: int, count: int) -> AsyncIterator[bytes]:
+        """
+        Stream the SSZ encoded ``SignedBeaconBlock``s of the given slot range, in slot order, as bytes or memoryviews.
+        Skipped slots have no block. Blocks are decoded by the range sync, once.
+        """
+        ...
+
+
+# SignedBeaconBlock: 4 byte offset of the message, 96 byte signature, then the message, starting with the slot.
+_SIGNED_BLOCK_SLOT_OFFSET = 4 + 96
+
+
+# The parent root follows the slot.
+_SIGNED_BLOCK_PARENT_ROOT_OFFSET = _SIGNED_BLOCK_SLOT_OFFSET + 8
+
+
+def encoded_block_slot(data: bytes) -> int:
+    """Read the slot of an SSZ encoded ``SignedBeaconBlock``, without decoding the block."""
+    return int.from_bytes(data[_SIGNED_BLOCK_SLOT_OFFSET:_SIGNED_BLOCK_SLOT_OFFSET + 8], 'little')
+
+
+def encoded_block_parent_root(data: bytes) -> bytes:
+    """Read the parent root of an SSZ encoded ``SignedBeaconBlock``, without decoding the block."""
+    return bytes(data[_SIGNED_BLOCK_PARENT_ROOT_OFFSET:_SIGNED_BLOCK_PARENT_ROOT_OFFSET + 32])
+
+
+def _decode_blocks(block_type, blocks: List[bytes]) -> Tuple[List, List[bytes]]:
+    """Decode SSZ encoded ``block_type`` blocks (e.g. ``SignedBeaconBlock``), and get their block roots."""
+    decoded = [block_type.decode_bytes(block) for block in blocks]
+    return decoded, [bytes(block.message.hash_tree_root()) for block in decoded]
+
+
+class RumorPeer(object):
+    """
+    A remote peer, reached through a Rumor actor, serving blocks over the BlocksByRange RPC.
+
+    Not hex-free: Rumor is controlled over a text protocol, requests go out hex encoded and chunks arrive
+    hex encoded, pyrum has no binary chunk path. Chunks are converted to bytes once, here,
+    the rest of the pipeline only handles raw SSZ bytes. ``StreamPeer`` is the binary transport.
+    """
+
+    def __init__(self, actor, peer_id: str):
+        self.actor = actor
+        self.peer_id = peer_id
+
+    async def blocks_by_range(self, start_slot: int, count: int) -> AsyncIterator[bytes]:
+        range_req = BlocksByRange(start_slot=start_slot, count=count, step=1).encode_bytes().hex()
+        req = self.actor.rpc.blocks_by_range.req.raw(self.peer_id, range_req, max_chunks=count, raw=True)
+        async for chunk in req.chunk():
+            if chunk['result_code'] != 0:
+                raise RangeRequestError(f"failed to get block from {self.peer_id}; msg: {chunk['msg']}")
+            yield bytes.fromhex(chunk["data"])
+
+
+BLOCKS_BY_RANGE_PROTOCOL = '/eth2/beacon_chain/req/beacon_blocks_by_range/1/ssz'
+
+# Upper bound of a request or response chunk payload, as in the networking spec
+MAX_CHUNK_SIZE = 2**20
+
+SUCCESS = 0
+SERVER_ERROR = 2
+
+
+def encode_uvarint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+class ChunkReader(object):
+    """
+    Reads the length-prefixed SSZ payloads of the ``ssz`` req/resp encoding from a byte stream.
+    Every payload is received into a buffer of its own, and handed out as a memoryview of it: no further copies.
+    """
+
+    def __init__(self, stream: trio.abc.ReceiveStream):
+        self.stream = stream
+        self.pending = bytearray()  # received, but not consumed yet
+
+    async def read_byte(self) -> Optional[int]:
+        """The next byte, or None if the stream ended."""
+        if not self.pending:
+            data = await self.stream.receive_some()
+            if not data:
+                return None
+            self.pending += data
+        value = self.pending[0]
+        del self.pending[:1]
+        return value
+
+    async def read_uvarint(self) -> int:
+        value = 0
+        for shift in range(0, 64, 7):
+            byte = await self.read_byte()
+            if byte is None:
+                raise RangeRequestError("stream ended inside a length prefix")
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+        raise RangeRequestError("length prefix too long")
+
+    async def read_payload(self) -> memoryview:
+        size = await self.read_uvarint()
+        if size > MAX_CHUNK_SIZE:
+            raise RangeRequestError(f"chunk of {size} bytes is larger than {MAX_CHUNK_SIZE}")
+        payload = memoryview(bytearray(size))
+        filled = min(size, len(self.pending))
+        payload[:filled] = self.pending[:filled]
+        del self.pending[:filled]
+        while filled < size:
+            # Never read past the payload, the rest of the stream stays in the stream.
+            data = await self.stream.receive_some(size - filled)
+            if not data:
+                raise RangeRequestError("stream ended inside a chunk")
+            payload[filled:filled + len(data)] = data
+            filled += len(data)
+        return payload
+
+
+class StreamPeer(object):
+    """
+    A remote peer, serving blocks over the BlocksByRange RPC on a byte stream: ``open_stream`` opens a new stream
+    for a protocol ID, e.g. a libp2p stream, or a TCP connection to ``serve_blocks_by_range``.
+
+    Binary all the way, no hex: the request goes out as SSZ bytes, and every response chunk is received into
+    a buffer of its own, that is handed on as a memoryview, straight to the decoder.
+    Only the ``ssz`` encoding is supported, not ``ssz_snappy``.
+    """
+
+    def __init__(self, open_stream: Callable[[str], Awaitable[trio.abc.HalfCloseableStream]], name: str = 'stream'):
+        self.open_stream = open_stream
+        self.name = name
+
+    async def blocks_by_range(self, start_slot: int, count: int) -> AsyncIterator[memoryview]:
+        stream = await self.open_stream(BLOCKS_BY_RANGE_PROTOCOL)
+        async with stream:
+            range_req = BlocksByRange(start_slot=start_slot, count=count, step=1).encode_bytes()
+            await stream.send_all(encode_uvarint(len(range_req)) + range_req)
+            await stream.send_eof()
+            reader = ChunkReader(stream)
+            for _ in range(count):
+                result = await reader.read_byte()
+                if result is None:
+                    return
+                payload = await reader.read_payload()
+                if result != SUCCESS:
+                    # The payload is an ErrorMessage: a byte list, encoded as is.
+                    msg = bytes(payload).decode('utf-8', errors='replace')
+                    raise RangeRequestError(f"failed to get block from {self.name}; msg: {msg}")
+                yield payload
+
+
+async def serve_blocks_by_range(stream: trio.abc.HalfCloseableStream, source: 'BlockSource') -> None:
+    """Answer a single BlocksByRange request on ``stream`` (see ``StreamPeer``) with the blocks of ``source``."""
+    async with stream:
+        range_req = BlocksByRange.decode_bytes(await ChunkReader(stream).read_payload())
+        try:
+            async for block in source.blocks_by_range(range_req.start_slot, range_req.count):
+                await stream.send_all(bytes([SUCCESS]) + encode_uvarint(len(block)))
+                await stream.send_all(block)
+        except RangeRequestError as e:
+            msg = str(e).encode('utf-8')[:256]
+            await stream.send_all(bytes([SERVER_ERROR]) + encode_uvarint(len(msg)) + msg)
+
+
+def block_file_name(slot: int) -> str:
+    return f"block_{slot}.ssz"
+
+
+def list_block_files(directory: str) -> Dict[int, str]:
+    """The paths of the block files (see ``block_file_name``) in ``directory``, by slot."""
+    block_files = {}
+    for name in os.listdir(directory):
+        if name.startswith('block_') and name.endswith('.ssz'):
+            block_files[int(name[len('block_'):-len('.ssz')])] = os.path.join(directory, name)
+    return block_files
+
+
+class DiskPeer(object):
+    """
+    A local fake peer, serving the ``block_<slot>.ssz`` files of a directory. No network needed.
+    Optionally adds a ``latency`` (seconds) to every request, to simulate slow peers.
+    """
+
+    def __init__(self, directory: str, latency: float = 0.0):
+        self.directory = directory
+        self.latency = latency
+        self.block_files: Dict[int, str] = list_block_files(directory)
+
+    async def blocks_by_range(self, start_slot: int, count: int) -> AsyncIterator[bytes]:
+        await trio.sleep(self.latency)
+        for slot in range(start_slot, start_slot + count):
+            if slot in self.block_files:
+                with io.open(self.block_files[slot], 'br') as f:
+                    yield f.read()
+            await trio.sleep(0)
+
+
+class RangeSyncError(Exception):
+    pass
+
+
+class SyncPeer(object):
+    """Bookkeeping of a peer during range sync: measured throughput and latency, and its current batch size."""
+    source: BlockSource
+    batch_size: int
+    throughput: float  # slots per second, moving average
+    latency: float  # seconds per request, moving average
+    failures: int  # consecutive failures
+    in_flight: int
+
+    def __init__(self, source: BlockSource, batch_size: int):
+        self.source = source
+        self.batch_size = batch_size
+        self.throughput = 0.0
+        self.latency = 0.0
+        self.failures = 0
+        self.in_flight = 0
+
+
+class Batch(object):
+    start_slot: int
+    count: int
+    tried: Set[SyncPeer]
+    empty_responses: int
+    link_failures: int  # times the first block did not build on the previously forwarded block
+    blocks: Optional[List[bytes]]
+    decoded: Optional[List]  # the decoded blocks, if RangeSync decodes them
+    roots: Optional[List[bytes]]  # block roots of the decoded blocks
+    served_by: Optional[SyncPeer]
+
+    def __init__(self, start_slot: int, count: int):
+        self.start_slot = start_slot
+        self.count = count
+        self.tried = set()
+        self.empty_responses = 0
+        self.link_failures = 0
+        self.blocks = None
+        self.decoded = None
+        self.roots = None
+        self.served_by = None
+
+
+class BatchResult(NamedTuple):
+    peer: SyncPeer
+    batch: Batch
+    blocks: List[bytes]
+    decoded: Optional[List]
+    roots: Optional[List[bytes]]
+    elapsed: float
+    error: Optional[Exception]
+
+
+class RangeSync(object):
+    """
+    Range sync scheduler: splits ``[start_slot, end_slot)`` into batches, and hands them out to peers with
+    less than ``requests_per_peer`` requests in flight, fastest peer first. Failed or empty batches are retried
+    with other peers. Batch sizes grow when a peer responds faster than ``target_latency``,
+    and shrink when it is slower.
+    Blocks are forwarded in slot order, no matter in which order the batches complete, still SSZ encoded.
+
+    With ``block_type``, responses are decoded (in a worker thread, once per block) and have to be a chain: every
+    block builds on the one before it. The decoded blocks are forwarded instead. A batch is only forwarded if its
+    first block builds on the last forwarded block (or on ``start_parent_root``). If not, the response before it
+    was cut short, e.g. by a peer that is behind: the missing tail is retried with another peer first,
+    then the batch itself.
+    """
+
+    def __init__(self, sources: Sequence[BlockSource], start_slot: int, end_slot: int,
+                 requests_per_peer: int = 2, batch_size: int = 20, min_batch_size: int = 4, max_batch_size: int = 256,
+                 target_latency: float = 2.0, request_timeout: float = 30.0,
+                 max_ahead_slots: int = 1024, empty_retries: int = 2, max_peer_failures: int = 3,
+                 block_type=None, start_parent_root: Optional[bytes] = None):
+        self.peers: List[SyncPeer] = [SyncPeer(source, batch_size) for source in sources]
+        self.requests_per_peer = requests_per_peer
+        self.start_slot = start_slot
+        self.end_slot = end_slot
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.request_timeout = request_timeout
+        self.max_ahead_slots = max_ahead_slots
+        self.empty_retries = empty_retries
+        self.max_peer_failures = max_peer_failures
+        self.block_type = block_type
+        # Batches by start slot, from the next slot to emit up to the latest requested slot.
+        self.batches: Dict[int, Batch] = {}
+        self.retry: Deque[Batch] = deque()
+        self.next_slot = start_slot
+        self.emit_slot = start_slot
+        # The last forwarded block, the next one has to build on it.
+        self.head_slot = start_slot - 1
+        self.head_root = None if start_parent_root is None else bytes(start_parent_root)
+        self.head_peer: Optional[SyncPeer] = None
+
+    async def _request(self, peer: SyncPeer, batch: Batch, results: trio.abc.SendChannel):
+        start = trio.current_time()
+        blocks = []
+        decoded = None
+        roots = None
+        error = None
+        try:
+            with trio.fail_after(self.request_timeout):
+                async for block in peer.source.blocks_by_range(batch.start_slot, batch.count):
+                    blocks.append(block)
+            prev_slot = batch.start_slot - 1
+            for block in blocks:
+                slot = encoded_block_slot(block)
+                if not (prev_slot < slot < batch.start_slot + batch.count):
+                    raise RangeRequestError(f"block at slot {slot} out of order or out of range")
+                prev_slot = slot
+            if self.block_type is not None:
+                decoded, roots = await trio.to_thread.run_sync(_decode_blocks, self.block_type, blocks)
+                for block, parent_root in zip(blocks[1:], roots[:-1]):
+                    if encoded_block_parent_root(block) != parent_root:
+                        raise RangeRequestError(f"block at slot {encoded_block_slot(block)} does not build on "
+                                                f"the block before it")
+        except Exception as e:  # Includes trio.TooSlowError
+            error = e
+        await results.send(BatchResult(peer, batch, blocks, decoded, roots, trio.current_time() - start, error))
+
+    def _update_peer(self, result: BatchResult):
+        peer = result.peer
+        peer.in_flight -= 1
+        if peer not in self.peers:
+            return  # Already dropped
+        if result.error is not None:
+            peer.failures += 1
+            peer.batch_size = max(self.min_batch_size, peer.batch_size // 2)
+            if peer.failures >= self.max_peer_failures:
+                print(f"dropping sync peer after {peer.failures} failures: {result.error}")
+                self.peers.remove(peer)
+                return
+        else:
+            peer.failures = 0
+            elapsed = max(result.elapsed, 1e-6)
+            throughput = result.batch.count / elapsed
+            peer.throughput = throughput if peer.throughput == 0 else 0.7 * peer.throughput + 0.3 * throughput
+            peer.latency = elapsed if peer.latency == 0 else 0.7 * peer.latency + 0.3 * elapsed
+            if peer.latency < self.target_latency / 2:
+                peer.batch_size = min(self.max_batch_size, peer.batch_size * 2)
+            elif peer.latency > self.target_latency:
+                peer.batch_size = max(self.min_batch_size, peer.batch_size // 2)
+
+    def _handle_result(self, result: BatchResult):
+        batch = result.batch
+        if result.error is not None:
+            print(f"batch {batch.start_slot}+{batch.count} failed, retrying elsewhere: {result.error}")
+            self.retry.append(batch)
+        elif len(result.blocks) == 0 and batch.empty_responses < self.empty_retries \
+                and any(peer not in batch.tried for peer in self.peers):
+            # Could be skipped slots, or a peer that is behind. Ask someone else before accepting it as empty.
+            batch.empty_responses += 1
+            self.retry.append(batch)
+        else:
+            batch.blocks = result.blocks
+            batch.decoded = result.decoded
+            batch.roots = result.roots
+            batch.served_by = result.peer
+        self._update_peer(result)
+
+    def _links(self, batch: Batch) -> bool:
+        if self.head_root is None or len(batch.blocks) == 0:
+            return True
+        return encoded_block_parent_root(batch.blocks[0]) == self.head_root
+
+    def _retry_unlinked(self, batch: Batch):
+        # The first block of the batch does not build on the last forwarded block.
+        batch.link_failures += 1
+        gap_start = self.head_slot + 1
+        if batch.link_failures == 1 and gap_start < batch.start_slot:
+            # Blocks are missing in between: the response that ended with the last forwarded block was cut short.
+            # Ask someone else for the tail, the batch waits for it.
+            print(f"blocks missing between slot {self.head_slot} and {batch.start_slot}, retrying that range")
+            gap = Batch(gap_start, batch.start_slot - gap_start)
+            if self.head_peer is not None:
+                gap.tried.add(self.head_peer)
+            self.batches[gap_start] = gap
+            self.emit_slot = gap_start
+            self.retry.append(gap)
+        elif batch.link_failures <= 2:
+            # Nothing is missing in between, this batch is off: retry it elsewhere.
+            print(f"batch {batch.start_slot}+{batch.count} does not build on slot {self.head_slot}, retrying elsewhere")
+            batch.blocks = None
+            batch.decoded = None
+            batch.roots = None
+            self.retry.append(batch)
+        else:
+            raise RangeSyncError(f"blocks from slot {batch.start_slot} do not build on "
+                                 f"the block at slot {self.head_slot}")
+
+    def _dispatch(self, nursery: trio.Nursery, results: trio.abc.SendChannel):
+        while True:
+            idle = [peer for peer in self.peers if peer.in_flight < self.requests_per_peer]
+            if not idle:
+                return
+            if self.retry:
+                batch = self.retry[0]
+                candidates = [peer for peer in idle if peer not in batch.tried]
+                if not candidates:
+                    # Everyone idle has tried it already, only retry with them if nobody else is left.
+                    if any(peer not in batch.tried for peer in self.peers):
+                        return
+                    candidates = idle
+                peer = max(candidates, key=lambda p: p.throughput)
+                self.retry.popleft()
+            elif self.next_slot < self.end_slot and self.next_slot - self.emit_slot < self.max_ahead_slots:
+                peer = max(idle, key=lambda p: p.throughput)
+                batch = Batch(self.next_slot, min(peer.batch_size, self.end_slot - self.next_slot))
+                self.batches[batch.start_slot] = batch
+                self.next_slot += batch.count
+            else:
+                return
+            peer.in_flight += 1
+            batch.tried.add(peer)
+            nursery.start_soon(self._request, peer, batch, results)
+
+    async def run(self, send_channel: trio.abc.SendChannel):
+        """Producer: forward all blocks of the range into ``send_channel``, in slot order."""
+        results_send, results_receive = trio.open_memory_channel(len(self.peers) * self.requests_per_peer)
+        async with send_channel, trio.open_nursery() as nursery:
+            self._dispatch(nursery, results_send)
+            while self.emit_slot < self.end_slot:
+                if not self.peers:
+                    raise RangeSyncError(f"no peers left to sync from, stuck at slot {self.emit_slot}")
+                self._handle_result(await results_receive.receive())
+                # Forward completed batches, in order
+                while self.emit_slot in self.batches and self.batches[self.emit_slot].blocks is not None:
+                    batch = self.batches[self.emit_slot]
+                    if not self._links(batch):
+                        self._retry_unlinked(batch)
+                        continue
+                    del self.batches[self.emit_slot]
+                    for block in (batch.blocks if batch.decoded is None else batch.decoded):
+                        await send_channel.send(block)
+                    if len(batch.blocks) > 0:
+                        self.head_slot = encoded_block_slot(batch.blocks[-1])
+                        self.head_root = None if batch.roots is None else batch.roots[-1]
+                        self.head_peer = batch.served_by
+                    self.emit_slot += batch.count
+                self._dispatch(nursery, results_send)
+
+
+async def process_blocks(receive_channel: trio.abc.ReceiveChannel, process: Callable,
+                         idle: Optional[Callable] = None):
+    """
+    Consumer: run ``process`` on every block, in order, until the producer closes the channel.
+    It runs in a worker thread, one block at a time, the event loop only waits for it: ``process`` can block
+    on other work (e.g. an epoch transition in a worker process).
+    When no block is ready, ``idle`` runs first (in a worker thread, the downloads continue), e.g. to advance
+    the head state to the next slot ahead of time. It runs again every time the consumer catches up,
+    keep it idempotent.
+    """
+    async with receive_channel:
+        while True:
+            try:
+                block = receive_channel.receive_nowait()
+            except trio.WouldBlock:
+                if idle is not None:
+                    await trio.to_thread.run_sync(idle)
+                try:
+                    block = await receive_channel.receive()
+                except trio.EndOfChannel:
+                    break
+            except trio.EndOfChannel:
+                break
+            await trio.to_thread.run_sync(process, block)
+
+
+async def sync_blocks(peers: Sequence[BlockSource], start_slot: int, end_slot: int,
+                      block_type, process: Callable, idle: Optional[Callable] = None,
+                      buffer_size: int = 64, **range_sync_args):
+    """
+    Download (see ``RangeSync``) and process the blocks of slots ``[start_slot, end_slot)`` concurrently.
+    The channel between the two holds at most ``buffer_size`` blocks, the producer blocks when it is full.
+    ``idle`` runs whenever the processing caught up with the downloads, see ``process_blocks``.
+    Blocks are decoded as ``block_type`` once, while downloading, and checked to be a chain,
+    pass ``start_parent_root`` to anchor it. ``process`` gets the decoded blocks.
+    """
+    send_channel, receive_channel = trio.open_memory_channel(buffer_size)
+    range_sync = RangeSync(peers, start_slot, end_slot, block_type=block_type, **range_sync_args)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(range_sync.run, send_channel)
+        nursery.start_soon(process_blocks, receive_channel, process, idle)
@@ -0,0 +1,141 @@
+import random
+from typing import List, Tuple
+
+import pytest
+
+import canon_spec as spec
+
+from attestation_pool import AttestationPool, bits_to_int, int_to_bits, popcount
+
+COMMITTEE_SIZE = 64
+
+
+@pytest.fixture(autouse=True)
+def no_bls():
+    bls_active = spec.bls.bls_active
+    spec.bls.bls_active = False
+    yield
+    spec.bls.bls_active = bls_active
+
+
+def make_data(slot: int, index: int = 0) -> spec.AttestationData:
+    # The source matches the (empty) justified checkpoints of a fresh state.
+    return spec.AttestationData(slot=slot, index=index,
+                                target=spec.Checkpoint(epoch=spec.compute_epoch_at_slot(slot)))
+
+
+def make_attestation(data: spec.AttestationData, positions) -> spec.Attestation:
+    bits = sum(1 << i for i in positions)
+    return spec.Attestation(aggregation_bits=int_to_bits(bits, COMMITTEE_SIZE), data=data)
+
+
+def make_state(slot: int) -> spec.BeaconState:
+    return spec.BeaconState(slot=slot)
+
+
+def test_bits_round_trip():
+    bits = (1 << 0) | (1 << 9) | (1 << 63)
+    assert bits_to_int(int_to_bits(bits, COMMITTEE_SIZE)) == bits
+
+
+def test_overlapping_bits_are_not_merged():
+    pool = AttestationPool()
+    data = make_data(10)
+    data_root = spec.hash_tree_root(data)
+    assert pool.add(make_attestation(data, [0, 1]))
+    assert pool.add(make_attestation(data, [1, 2]))
+    assert sorted(aggregate.bits for aggregate in pool.aggregates[data_root]) == [0b011, 0b110]
+    # Does not overlap with the first aggregate: merged into it
+    assert pool.add(make_attestation(data, [5]))
+    assert sorted(aggregate.bits for aggregate in pool.aggregates[data_root]) == [0b110, 0b100011]
+    # Covered by a single aggregate already
+    assert not pool.add(make_attestation(data, [1]))
+    assert len(pool) == 2
+
+
+def test_prune_at_the_inclusion_window_boundary():
+    pool = AttestationPool()
+    data = make_data(10)
+    pool.add(make_attestation(data, [0]))
+    last_slot = 10 + spec.SLOTS_PER_EPOCH
+    assert pool.is_includable(make_state(last_slot), data)
+    assert not pool.is_includable(make_state(last_slot + 1), data)
+    pool.prune(last_slot)
+    assert len(pool) == 1
+    pool.prune(last_slot + 1)
+    assert len(pool) == 0
+    assert len(pool.data) == 0 and len(pool.lengths) == 0
+
+
+def test_is_includable_inclusion_delay():
+    pool = AttestationPool()
+    data = make_data(10)
+    assert not pool.is_includable(make_state(10 + spec.MIN_ATTESTATION_INCLUSION_DELAY - 1), data)
+    assert pool.is_includable(make_state(10 + spec.MIN_ATTESTATION_INCLUSION_DELAY), data)
+
+
+def test_pack_max_attestations_by_coverage():
+    pool = AttestationPool()
+    slot = spec.SLOTS_PER_EPOCH + 2
+    count = spec.MAX_ATTESTATIONS + 10
+    for index in range(count):
+        # Coverage grows with the index: the lowest 10 are left out
+        pool.add(make_attestation(make_data(slot, index), range(1 + index % COMMITTEE_SIZE)))
+    state = make_state(slot + 1)
+    packed = pool.pack(state)
+    assert len(packed) == spec.MAX_ATTESTATIONS
+    coverages = sorted((1 + index % COMMITTEE_SIZE for index in range(count)), reverse=True)
+    assert sorted((popcount(bits_to_int(a.aggregation_bits)) for a in packed), reverse=True) \
+        == coverages[:spec.MAX_ATTESTATIONS]
+    assert len(pool.pack(state, max_count=3)) == 3
+
+
+def test_pack_skips_on_chain_bits():
+    pool = AttestationPool()
+    slot = spec.SLOTS_PER_EPOCH + 2
+    data = make_data(slot)
+    pool.add(make_attestation(data, [0, 1, 2, 3]))
+    pool.add(make_attestation(data, [3, 4]))
+    state = make_state(slot + 1)
+    state.current_epoch_attestations.append(spec.PendingAttestation(
+        aggregation_bits=int_to_bits(0b1111, COMMITTEE_SIZE), data=data))
+    packed = pool.pack(state)
+    assert [bits_to_int(a.aggregation_bits) for a in packed] == [0b11000]
+
+
+def naive_pack(pool: AttestationPool, state: spec.BeaconState, max_count: int) -> List[Tuple[bytes, int]]:
+    """Greedy max-coverage, recomputing every gain every round. Ties go to the first candidate."""
+    candidates = [(data_root, aggregate.bits)
+                  for data_root, aggregates in pool.aggregates.items()
+                  if pool.is_includable(state, pool.data[data_root])
+                  for aggregate in aggregates]
+    covered = pool.included_bits(state)
+    picked = []
+    while len(picked) < max_count:
+        best, best_gain = None, 0
+        for data_root, bits in candidates:
+            gain = popcount(bits & ~covered.get(data_root, 0))
+            if gain > best_gain:
+                best, best_gain = (data_root, bits), gain
+        if best is None:
+            break
+        picked.append(best)
+        covered[best[0]] = covered.get(best[0], 0) | best[1]
+    return picked
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_lazy_pack_matches_naive_greedy(seed):
+    rng = random.Random(seed)
+    pool = AttestationPool()
+    slot = spec.SLOTS_PER_EPOCH + 2
+    datas = [make_data(slot - rng.randrange(3), index) for index in range(8)]
+    for _ in range(200):
+        data = rng.choice(datas)
+        start = rng.randrange(COMMITTEE_SIZE)
+        pool.add(make_attestation(data, range(start, min(COMMITTEE_SIZE, start + rng.randrange(1, 16)))))
+    state = make_state(slot + 1)
+    for max_count in (1, 5, 20, spec.MAX_ATTESTATIONS):
+        packed = [(spec.hash_tree_root(a.data), bits_to_int(a.aggregation_bits))
+                  for a in pool.pack(state, max_count=max_count)]
+        assert packed == naive_pack(pool, state, max_count)
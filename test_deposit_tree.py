@@ -0,0 +1,37 @@
+from hashlib import sha256
+
+import pytest
+
+from deposit_tree import DepositTree
+
+
+def _hash(data: bytes) -> bytes:
+    return sha256(data).digest()
+
+
+def _full_root(leaves):
+    # Naive root of a full tree: hash every layer pairwise.
+    layer = list(leaves)
+    while len(layer) > 1:
+        layer = [_hash(layer[i] + layer[i + 1]) for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def _verify(leaf: bytes, proof, index: int, root: bytes) -> bool:
+    node = leaf
+    for height, sibling in enumerate(proof):
+        node = _hash(sibling + node) if (index >> height) % 2 == 1 else _hash(node + sibling)
+    return node == root
+
+
+def test_fill_to_capacity():
+    depth = 3
+    tree = DepositTree(depth)
+    leaves = [bytes([i + 1]) * 32 for i in range(2**depth)]
+    for i, leaf in enumerate(leaves):
+        tree.append(leaf)
+        padded = leaves[:i + 1] + [bytes(32)] * (2**depth - i - 1)
+        assert tree.root() == _hash(_full_root(padded) + (i + 1).to_bytes(32, 'little'))
+        assert _verify(leaf, tree.last_proof(), i, tree.root())
+    with pytest.raises(AssertionError):
+        tree.append(bytes(32))
@@ -0,0 +1,56 @@
+"""
+The per-slot state root only rehashes the paths written since the previous root: remerkleable keeps the roots
+of unchanged subtrees cached. Pins that down, a regression to a full walk of the state tree would show up here.
+"""
+from importlib import reload
+
+import pytest
+
+import remerkleable.tree
+
+from eth2spec.config.config_util import prepare_config
+
+import canon_spec as spec
+
+prepare_config("./lighthouse", "config")
+reload(spec)
+
+# Every slot writes state_roots, block_roots and slot: a few paths of ~20 nodes each. A full walk is millions.
+MAX_HASHES_PER_SLOT = 64
+
+
+@pytest.fixture
+def state():
+    with open('lighthouse/genesis.ssz', 'rb') as f:
+        state = spec.BeaconState.decode_bytes(f.read())
+    # Hash everything once, like the state of the previous slot would be.
+    spec.process_slot(state)
+    state.slot += 1
+    return state
+
+
+@pytest.fixture
+def hash_count(monkeypatch):
+    count = [0]
+    merkle_hash = remerkleable.tree.merkle_hash
+
+    def counting_merkle_hash(a, b):
+        count[0] += 1
+        return merkle_hash(a, b)
+
+    monkeypatch.setattr(remerkleable.tree, 'merkle_hash', counting_merkle_hash)
+    return count
+
+
+def test_process_slot_rehashes_dirty_paths(state, hash_count):
+    for _ in range(5):
+        hash_count[0] = 0
+        spec.process_slot(state)
+        state.slot += 1
+        assert hash_count[0] <= MAX_HASHES_PER_SLOT
+
+
+def test_empty_slot_run_rehashes_dirty_paths(state, hash_count):
+    slots = spec.SLOTS_PER_EPOCH - 2 - state.slot
+    spec.process_empty_slots(state, state.slot + slots)
+    assert hash_count[0] <= MAX_HASHES_PER_SLOT * slots
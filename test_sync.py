@@ -0,0 +1,132 @@
+import io
+import os
+from typing import AsyncIterator, List, Tuple
+
+import trio
+import trio.testing
+
+import canon_spec as spec
+
+from sync import BLOCKS_BY_RANGE_PROTOCOL, DiskPeer, RangeRequestError, RangeSync, StreamPeer, block_file_name, \
+    process_blocks, serve_blocks_by_range
+
+START_PARENT_ROOT = b'\x11' * 32
+
+
+def write_chain(directory: str, end_slot: int, skipped=lambda slot: slot % 7 == 0) -> List[int]:
+    """Write a chain of empty blocks for slots ``[1, end_slot)`` into ``directory``, and return their slots."""
+    parent_root = START_PARENT_ROOT
+    slots = []
+    for slot in range(1, end_slot):
+        if skipped(slot):
+            continue
+        block = spec.SignedBeaconBlock(message=spec.BeaconBlock(slot=slot, parent_root=parent_root))
+        with io.open(os.path.join(directory, block_file_name(slot)), 'bw') as f:
+            f.write(block.encode_bytes())
+        parent_root = block.message.hash_tree_root()
+        slots.append(slot)
+    return slots
+
+
+class FailingPeer(object):
+    """Fails every request."""
+
+    async def blocks_by_range(self, start_slot: int, count: int) -> AsyncIterator[bytes]:
+        await trio.sleep(0)
+        raise RangeRequestError("peer failure")
+        yield
+
+
+class TruncatingPeer(object):
+    """Serves ``source``, but cuts off the last ``cut`` blocks of its first non-empty response, like a peer behind."""
+
+    def __init__(self, source: DiskPeer, cut: int):
+        self.source = source
+        self.cut = cut
+        self.truncated = False
+
+    async def blocks_by_range(self, start_slot: int, count: int) -> AsyncIterator[bytes]:
+        blocks = [block async for block in self.source.blocks_by_range(start_slot, count)]
+        if not self.truncated and len(blocks) > self.cut:
+            self.truncated = True
+            blocks = blocks[:-self.cut]
+        for block in blocks:
+            yield block
+
+
+def run_sync(peers, end_slot: int, **range_sync_args) -> Tuple[RangeSync, List[int]]:
+    received = []
+    range_sync = RangeSync(peers, 1, end_slot, block_type=spec.SignedBeaconBlock,
+                           start_parent_root=START_PARENT_ROOT, **range_sync_args)
+
+    async def main():
+        send_channel, receive_channel = trio.open_memory_channel(16)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(range_sync.run, send_channel)
+            nursery.start_soon(process_blocks, receive_channel, lambda b: received.append(int(b.message.slot)))
+
+    trio.run(main)
+    return range_sync, received
+
+
+def test_failing_peer(tmp_path):
+    slots = write_chain(str(tmp_path), 120)
+    range_sync, received = run_sync([FailingPeer(), DiskPeer(str(tmp_path))], 120, batch_size=8)
+    assert received == slots
+    # Dropped after max_peer_failures
+    assert len(range_sync.peers) == 1
+
+
+def test_empty_peer(tmp_path):
+    full_dir = tmp_path / 'full'
+    empty_dir = tmp_path / 'empty'
+    full_dir.mkdir()
+    empty_dir.mkdir()
+    slots = write_chain(str(full_dir), 120)
+    _, received = run_sync([DiskPeer(str(empty_dir)), DiskPeer(str(full_dir))], 120, batch_size=8)
+    assert received == slots
+
+
+def test_truncated_response_gap_retry(tmp_path):
+    slots = write_chain(str(tmp_path), 200, skipped=lambda slot: False)
+    truncating = TruncatingPeer(DiskPeer(str(tmp_path)), cut=3)
+    _, received = run_sync([truncating, DiskPeer(str(tmp_path))], 200, batch_size=8, requests_per_peer=1)
+    assert truncating.truncated
+    assert received == slots
+
+
+def test_batch_sizes_adapt(tmp_path):
+    slots = write_chain(str(tmp_path), 300)
+    fast = DiskPeer(str(tmp_path))
+    slow = DiskPeer(str(tmp_path), latency=0.3)
+    range_sync, received = run_sync([fast, slow], 300, batch_size=8, min_batch_size=2, max_batch_size=64,
+                                    target_latency=0.2)
+    assert received == slots
+    fast_peer, slow_peer = range_sync.peers
+    assert fast_peer.batch_size > 8
+    assert slow_peer.batch_size < 8
+    assert fast_peer.throughput > 0 and fast_peer.latency < slow_peer.latency
+
+
+class StreamServer(object):
+    """Opens in-memory streams to ``serve_blocks_by_range``, answering from ``source``."""
+
+    def __init__(self, source):
+        self.source = source
+        self.streams = 0
+
+    async def open_stream(self, protocol: str):
+        assert protocol == BLOCKS_BY_RANGE_PROTOCOL
+        self.streams += 1
+        client, server = trio.testing.memory_stream_pair()
+        trio.lowlevel.spawn_system_task(serve_blocks_by_range, server, self.source)
+        return client
+
+
+def test_stream_peer(tmp_path):
+    slots = write_chain(str(tmp_path), 120)
+    server = StreamServer(DiskPeer(str(tmp_path)))
+    failing = StreamServer(FailingPeer())
+    _, received = run_sync([StreamPeer(failing.open_stream), StreamPeer(server.open_stream)], 120, batch_size=8)
+    assert received == slots
+    assert failing.streams > 0 and server.streams > 0
@@ -0,0 +1,82 @@
+from typing import Optional, Tuple, Type
+
+from remerkleable.core import View
+from remerkleable.basic import BasicView
+from remerkleable.complex import Container, List, Vector
+from remerkleable.tree import Node
+
+
+def first_diff_gindex(a: Node, b: Node, gindex: int = 1) -> Optional[int]:
+    """
+    Return the generalized index of the left-most node where ``a`` and ``b`` diverge, None if they are equal.
+    The node is a leaf, or the point where one of the two trees is a leaf while the other is not.
+    Shared subtrees are skipped by identity first, then by (cached) root, without hashing anything new.
+    """
+    if a is b or a.root == b.root:
+        return None
+    while True:
+        if a.is_leaf() or b.is_leaf():
+            return gindex
+        a_left, b_left = a.get_left(), b.get_left()
+        if a_left is not b_left and a_left.root != b_left.root:
+            a, b, gindex = a_left, b_left, gindex * 2
+        else:
+            a, b, gindex = a.get_right(), b.get_right(), gindex * 2 + 1
+
+
+def _split_gindex(gindex: int, depth: int) -> Tuple[int, int]:
+    """Split ``gindex`` into the index at ``depth``, and the remaining gindex relative to that subtree."""
+    below = gindex.bit_length() - 1 - depth
+    return (gindex >> below) & ((1 << depth) - 1), (1 << below) | (gindex & ((1 << below) - 1))
+
+
+def gindex_path(typ: Type[View], gindex: int) -> str:
+    """
+    Describe the position of ``gindex`` in a tree of type ``typ``, e.g. ``validators[123].effective_balance``.
+    The description stops at the deepest known field, if the gindex points into the internals of a subtree.
+    """
+    path = ''
+    while gindex > 1:
+        if issubclass(typ, Container):
+            depth = typ.tree_depth()
+            if gindex.bit_length() - 1 < depth:
+                break
+            i, gindex = _split_gindex(gindex, depth)
+            fields = list(typ.fields().items())
+            if i >= len(fields):
+                return path + '.<padding>'
+            name, typ = fields[i]
+            path += ('.' if path else '') + name
+        elif issubclass(typ, (List, Vector)):
+            if issubclass(typ, List):
+                # Lists mix in their length on the right of the contents
+                if gindex.bit_length() - 1 < 1:
+                    break
+                mix_in, gindex = _split_gindex(gindex, 1)
+                if mix_in == 1:
+                    return path + '.<length>'
+                depth = typ.contents_depth()
+            else:
+                depth = typ.tree_depth()
+            if gindex.bit_length() - 1 < depth:
+                break
+            i, gindex = _split_gindex(gindex, depth)
+            elem_typ = typ.element_cls()
+            if issubclass(elem_typ, BasicView):
+                # Packed elements: the leaf is a chunk of multiple elements
+                per_chunk = 32 // elem_typ.type_byte_length()
+                return path + f'[{i * per_chunk}:{(i + 1) * per_chunk}]'
+            path += f'[{i}]'
+            typ = elem_typ
+        else:
+            break
+    return path
+
+
+def describe_diff(typ: Type[View], a: Node, b: Node) -> Optional[str]:
+    """Human readable description of the first divergence between ``a`` and ``b`` (backings of type ``typ``)."""
+    gindex = first_diff_gindex(a, b)
+    if gindex is None:
+        return None
+    return (f"{gindex_path(typ, gindex) or '<root>'} (gindex {gindex}): "
+            f"{a.getter(gindex).root.hex()} != {b.getter(gindex).root.hex()}")
@@ -0,0 +1,176 @@
+"""
+CPU-heavy state transitions (epoch processing, full block transitions) in worker processes,
+so the trio event loop (RPC, peer handling, downloads) stays responsive while they run.
+
+Input states are handed over as shared memory node tables (see ``shared_state.py``), blocks and the resulting states
+as SSZ bytes. Each worker loads the config and the spec module once, in its initializer.
+Results are waited for in a trio worker thread, which only holds the GIL to export and decode.
+
+Workers are started by a forkserver: the first job is submitted from a trio worker thread, and forking the
+multithreaded main process could copy locks held by other threads. Only module-level functions and plain arguments
+(e.g. the shared memory name) cross the process boundary, and the main module is imported again by the forkserver:
+scripts using the workers have to guard their entry point with ``if __name__ == '__main__'``.
+"""
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module, reload
+from typing import Callable, Deque, Dict, TypeVar
+
+import trio
+
+from eth2spec.config.config_util import prepare_config
+
+from remerkleable.core import View
+
+from shared_state import attach_tree, export_tree
+
+S = TypeVar('S', bound=View)
+
+# The spec module of this worker process, see _init_worker
+_spec = None
+
+
+def _init_worker(spec_name: str, config_path: str, config_name: str, bls_active: bool) -> None:
+    global _spec
+    prepare_config(config_path, config_name)
+    _spec = reload(import_module(spec_name))
+    _spec.bls.bls_active = bls_active
+
+
+def _spec_args(state: View) -> tuple:
+    # fast_spec transition functions take an epochs context first, canon_spec functions only the state.
+    if hasattr(_spec, 'EpochsContext'):
+        epochs_ctx = _spec.EpochsContext()
+        epochs_ctx.load_state(state)
+        return epochs_ctx, state
+    return state,
+
+
+def _release_tree() -> None:
+    # Nodes of the shared tree are unreadable once it is closed: spec caches must not follow them into the next job.
+    if hasattr(_spec, 'clear_state_caches'):
+        _spec.clear_state_caches()
+
+
+def _process_slots(state_tree: str, slot: int) -> bytes:
+    with attach_tree(state_tree) as tree:
+        try:
+            state = tree.view(_spec.BeaconState)
+            _spec.process_slots(*_spec_args(state), slot)
+            return state.encode_bytes()
+        finally:
+            _release_tree()
+
+
+def _state_transition(state_tree: str, signed_block_bytes: bytes) -> bytes:
+    with attach_tree(state_tree) as tree:
+        try:
+            state = tree.view(_spec.BeaconState)
+            signed_block = _spec.SignedBeaconBlock.decode_bytes(signed_block_bytes)
+            _spec.state_transition(*_spec_args(state), signed_block)
+            return state.encode_bytes()
+        finally:
+            _release_tree()
+
+
+class StateWorkers(object):
+    """
+    A process pool for state transitions with ``spec_name`` (``fast_spec`` or ``canon_spec``), configured like
+    the main process. The async methods can be awaited from trio tasks, the ``*_sync`` variants are for code
+    that already runs outside the event loop (e.g. the ``idle`` hook of ``sync_blocks``).
+    """
+    executor: ProcessPoolExecutor
+
+    def __init__(self, spec_name: str = 'fast_spec', config_path: str = './lighthouse', config_name: str = 'config',
+                 bls_active: bool = False, max_workers: int = 1):
+        self.executor = ProcessPoolExecutor(max_workers=max_workers,
+                                            mp_context=multiprocessing.get_context('forkserver'),
+                                            initializer=_init_worker,
+                                            initargs=(spec_name, config_path, config_name, bls_active))
+
+    def __enter__(self) -> 'StateWorkers':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def run_sync(self, fn: Callable, *args):
+        """Run ``fn`` (a module-level function, it is pickled) in a worker, and block until it is done."""
+        return self.executor.submit(fn, *args).result()
+
+    async def run(self, fn: Callable, *args):
+        """
+        Run ``fn`` in a worker, the event loop keeps running other tasks meanwhile.
+        Cancellation is deferred until the worker is done, the pool would otherwise keep running the job anyway.
+        """
+        future = self.executor.submit(fn, *args)
+        return await trio.to_thread.run_sync(future.result)
+
+    def run_on_state_sync(self, fn: Callable, state: View, *args):
+        """Run ``fn(state_tree_name, *args)`` in a worker, with ``state`` exported to shared memory meanwhile."""
+        tree = export_tree(state.get_backing())
+        try:
+            return self.run_sync(fn, tree.name, *args)
+        finally:
+            tree.close()
+            tree.unlink()
+
+    def process_slots_sync(self, state: S, slot: int) -> S:
+        """A new state: ``state`` (not modified) advanced to ``slot``, including any epoch transitions."""
+        return state.__class__.decode_bytes(self.run_on_state_sync(_process_slots, state, slot))
+
+    def state_transition_sync(self, state: S, signed_block: View) -> S:
+        """A new state: ``state`` (not modified) transitioned with ``signed_block``. Errors are raised here."""
+        post = self.run_on_state_sync(_state_transition, state, signed_block.encode_bytes())
+        return state.__class__.decode_bytes(post)
+
+    # Exporting and decoding a large state takes a second as well, the async variants do it in the waiting thread.
+    # The state is copied first (O(1)), so the caller can continue to use and modify its view meanwhile.
+
+    async def process_slots(self, state: S, slot: int) -> S:
+        return await trio.to_thread.run_sync(self.process_slots_sync, state.copy(), slot)
+
+    async def state_transition(self, state: S, signed_block: View) -> S:
+        return await trio.to_thread.run_sync(self.state_transition_sync, state.copy(), signed_block.copy())
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how responsive the event loop is: a task sleeps ``interval`` seconds, and records how much later
+    than requested it woke up. The lag is the time other work (e.g. a block transition) held the loop.
+    """
+    interval: float
+    lags: Deque[float]
+    max_lag: float
+
+    def __init__(self, interval: float = 0.05, window: int = 1200):
+        self.interval = interval
+        self.lags = deque(maxlen=window)
+        self.max_lag = 0.0
+
+    async def run(self) -> None:
+        """Monitor until cancelled, run it in the nursery of the work to watch."""
+        while True:
+            start = trio.current_time()
+            await trio.sleep(self.interval)
+            lag = max(0.0, trio.current_time() - start - self.interval)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def percentile(self, q: float) -> float:
+        if len(self.lags) == 0:
+            return 0.0
+        lags = sorted(self.lags)
+        return lags[min(len(lags) - 1, int(q * len(lags)))]
+
+    def summary(self) -> Dict[str, float]:
+        """Lag in milliseconds over the recent window, and the maximum since the start."""
+        return {
+            'p50_ms': self.percentile(0.5) * 1000.0,
+            'p99_ms': self.percentile(0.99) * 1000.0,
+            'max_ms': self.max_lag * 1000.0,
+        }